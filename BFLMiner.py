@@ -1,16 +1,21 @@
 from Miner import Miner
-from Queue import Empty
+from Queue import Empty, Queue
 from binascii import unhexlify
 from ioutil import find_udev, find_serial_by_id, find_com_ports
+from detect import WINDOWS
 from log import say_line, say_exception
+from select import select
 from serial.serialutil import SerialException
-from sys import maxint
+from threading import Lock, Thread
 from time import time, sleep
+from types import GeneratorType
 from util import Object
 import numpy as np
 import serial
 
 CHECK_INTERVAL = 0.01
+POLL_MARGIN = 0.05
+PREPARE_TIME = 0.5
 
 
 def open_device(port):
@@ -61,41 +66,172 @@ def initialize(options):
 		)
 	]
 
+	if options.bfl_shared_io and miners:
+		if WINDOWS:
+			say_line('--bfl-shared-io is not supported on Windows, using a thread per device')
+		else:
+			io_loop = IOLoop()
+			for miner in miners:
+				miner.io_loop = io_loop
+
 	for i in xrange(len(miners)):
 		miners[i].cutoff_temp = options.cutoff_temp[min(i, len(options.cutoff_temp) - 1)]
 		miners[i].cutoff_interval = options.cutoff_interval[min(i, len(options.cutoff_interval) - 1)]
 	return miners
 
+# drives the state machines of several BFLMiners from one thread, multiplexing their serial ports
+class IOLoop(object):
+	def __init__(self):
+		self.miners = []
+		self.lock = Lock()
+		self.thread = None
+		self.requests = Queue()
+
+	def add(self, miner):
+		miner.deadline = 0
+		miner.waiting = False
+		miner.buffer = b''
+		with self.lock:
+			self.miners.append(miner)
+			if not self.thread:
+				self.thread = Thread(target=self.loop)
+				self.thread.start()
+				Thread(target=self.request_thread).start()
+
+	def loop(self):
+		while True:
+			with self.lock:
+				miners = [miner for miner in self.miners if not miner.should_stop]
+				if not miners:
+					self.miners = []
+					self.thread = None
+					self.requests.put(None)
+					return
+
+			now = time()
+			for miner in miners:
+				if miner.deadline <= now:
+					# a response that timed out is passed on as far as it got, like readline does
+					self.advance(miner, miner.buffer if miner.waiting else None)
+
+			waiting = dict((miner.device, miner) for miner in miners if miner.waiting)
+			timeout = min(max(min([miner.deadline for miner in miners]) - time(), 0), 0.1)
+			if not waiting:
+				sleep(timeout)
+				continue
+
+			for device in select(waiting.keys(), [], [], timeout)[0]:
+				miner = waiting[device]
+				try:
+					miner.buffer += device.read(device.inWaiting() or 1)
+				except Exception:
+					self.fail(miner)
+					continue
+				if b'\n' in miner.buffer:
+					end = miner.buffer.index(b'\n') + 1
+					self.advance(miner, miner.buffer[:end])
+
+	def request_work(self, miner):
+		self.requests.put(miner)
+
+	def request_thread(self):
+		# work requests may build stratum headers or wait for the switch lock, every device's I/O would wait with them
+		while True:
+			miner = self.requests.get()
+			if not miner: return
+			try:
+				Miner.request_work(miner)
+			except Exception:
+				say_exception()
+
+	def advance(self, miner, response):
+		try:
+			action = miner.step(response)
+			if isinstance(action, float):
+				miner.waiting = False
+				miner.deadline = action
+			else:
+				miner.device.flushInput()
+				miner.device.write(action)
+				miner.buffer = b''
+				miner.waiting = True
+				miner.deadline = time() + miner.device.timeout
+		except Exception:
+			self.fail(miner)
+
+	def fail(self, miner):
+		say_exception()
+		miner.reset()
+		miner.waiting = False
+		miner.deadline = time() + 1
+
 class BFLMiner(Miner):
 	def __init__(self, device_index, port, options):
 		super(BFLMiner, self).__init__(device_index, options)
 		self.port = port
 		self.device_name = 'BFL:'+str(self.device_index)
+		self.device = None
+		self.io_loop = None
+		self.stack = []
 
 		self.check_interval = CHECK_INTERVAL
 		self.last_job = None
-		self.min_interval = maxint
+		self.job_duration = None
+		self.next_job = None
+
+		self.jobs_done = self.polls = self.late_polls = 0
+		self.idle_time = 0
 
 	def id(self):
 		return self.device_name
 
+	def start(self):
+		if not self.io_loop:
+			return super(BFLMiner, self).start()
+		self.should_stop = False
+		self.start_time = time()
+		say_line('started miner on %s', (self.id()))
+		self.io_loop.add(self)
+
+	def request_work(self):
+		# the session picks the job up from work_queue
+		if self.io_loop:
+			self.io_loop.request_work(self)
+		else:
+			super(BFLMiner, self).request_work()
+
 	def is_ok(self, response):
 		return response and response == b'OK\n'
 
+	def job_data(self):
+		if self.switch.update_time:
+			self.job.time = (np.uint32(time()) - self.job.time_delta).byteswap()
+		data = b''.join([self.job.state.tostring(), self.job.merkle_end.tostring(), self.job.time.tostring(), self.job.difficulty.tostring()])
+		return b''.join([b'>>>>>>>>', data, b'>>>>>>>>'])
+
+	def prepare_job(self):
+		if self.job and not self.next_job:
+			temperature = self.get_temperature((yield b'ZLX'))
+			self.next_job = (temperature, self.job_data())
+
 	def put_job(self):
-		if self.busy: return
+		if self.busy or not self.job: return
+
+		if self.next_job:
+			temperature, data = self.next_job
+		else:
+			temperature, data = self.get_temperature((yield b'ZLX')), None
+		self.next_job = None
 
-		temperature = self.get_temperature()
 		if temperature < self.cutoff_temp:
-			response = request(self.device, b'ZDX')
+			response = yield b'ZDX'
 			if self.is_ok(response):
-				if self.switch.update_time:
-					self.job.time = (np.uint32(time()) - self.job.time_delta).byteswap()
-				data = b''.join([self.job.state.tostring(), self.job.merkle_end.tostring(), self.job.time.tostring(), self.job.difficulty.tostring()])
-				response = request(self.device, b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
+				response = yield data or self.job_data()
 				if self.is_ok(response):
 					self.busy = True
 					self.job_started = time()
+					self.poll_time = self.job_started + (self.job_duration or 0) - POLL_MARGIN
+					self.last_busy = None
 
 					self.last_job = Object()
 					self.last_job.header = self.job.header
@@ -111,7 +247,7 @@ class BFLMiner(Miner):
 
 					self.check_interval = CHECK_INTERVAL
 					if not self.switch.update_time or self.job.time.byteswap() - self.job.original_time.byteswap() > 55:
-						self.update = True
+						self.request_work()
 						self.job = None
 				else:
 					say_line('%s: bad response when sending block data: %s', (self.id(), response))
@@ -120,15 +256,14 @@ class BFLMiner(Miner):
 		else:
 			say_line('%s: temperature exceeds cutoff, waiting...', self.id())
 
-	def get_temperature(self):
-		response = request(self.device, b'ZLX')
+	def get_temperature(self, response):
 		if response[0] != b'T' or len(response) < 23 or response[-1:] != b'\n':
 			say_line('%s: bad response for temperature: %s', (self.id(), response))
 			return 0
-		return float(response[23:-1])
+		self.temperature = float(response[23:-1])
+		return self.temperature
 
-	def check_result(self):
-		response = request(self.device, b'ZFX')
+	def check_result(self, response):
 		if response[0] == b'B': return False
 		if response == b'NO-NONCE\n': return response
 		if response[:12] != 'NONCE-FOUND:' or response[-1:] != '\n':
@@ -144,72 +279,130 @@ class BFLMiner(Miner):
 			except TypeError:
 				pass
 
+	def reset(self):
+		self.stack = []
+		if self.device:
+			self.device.close()
+			self.device = None
+
+	def step(self, response=None):
+		# advances the device state machine with the response to its last command and returns
+		# the next command to send, or the time to sleep until
+		if not self.stack:
+			self.stack.append(self.session())
+		while True:
+			try:
+				action = self.stack[-1].send(response)
+			except StopIteration:
+				self.stack.pop()
+				if not self.stack:
+					return time()
+				response = None
+				continue
+			if isinstance(action, GeneratorType):
+				self.stack.append(action)
+				response = None
+				continue
+			return action
+
 	def mining_thread(self):
 		say_line('started miner on %s', (self.id()))
 
+		response = None
 		while not self.should_stop:
 			try:
-				self.device = open_device(self.port)
-				response = init_device(self.device)
-				if not is_good_init(response):
-					say_line('Failed to initialize %s (response: %s), retrying...', (self.id(), response))
-					self.device.close()
-					self.device = None
-					sleep(1)
-					continue
+				action = self.step(response)
+				if isinstance(action, float):
+					response = None
+					sleep(max(action - time(), 0))
+				else:
+					response = request(self.device, action)
+			except Exception:
+				say_exception()
+				self.reset()
+				response = None
+				sleep(1)
+
+	def session(self):
+		self.device = open_device(self.port)
+		response = yield b'ZGX'
+		if not is_good_init(response):
+			say_line('Failed to initialize %s (response: %s), retrying...', (self.id(), response))
+			self.reset()
+			yield time() + 1
+			return
+
+		last_rated = time()
+		iterations = 0
 
-				last_rated = time()
-				iterations = 0
-		
-				self.job = None
-				self.busy = False
-				while not self.should_stop:
-					if (not self.job) or (not self.work_queue.empty()):
-						try:
-							self.job = self.work_queue.get(True, 1)
-						except Empty:
-							if not self.busy:
-								continue
-						else:
-							if not self.job and not self.busy:
-								continue
-							targetQ = self.job.targetQ
-							self.job.original_time = self.job.time
-							self.job.time_delta = np.uint32(time()) - self.job.time.byteswap()
-		
+		self.job = None
+		self.busy = False
+		while not self.should_stop:
+			if (not self.job) or (not self.work_queue.empty()):
+				try:
+					self.job = self.work_queue.get(False)
+				except Empty:
 					if not self.busy:
-						self.put_job()
+						yield time() + CHECK_INTERVAL
+						continue
+				else:
+					if self.job:
+						targetQ = self.job.targetQ
+						self.job.original_time = self.job.time
+						self.job.time_delta = np.uint32(time()) - self.job.time.byteswap()
+						self.next_job = None
+					elif not self.busy:
+						continue
+
+			if not self.busy:
+				yield self.put_job()
+			else:
+				# sleep until shortly before the job should finish, read the temperature
+				# and build the next job's data, then poll tightly
+				wait = self.poll_time - time()
+				if wait > PREPARE_TIME:
+					yield time() + min(wait - PREPARE_TIME, 1)
+					continue
+				yield self.prepare_job()
+				if wait > 0:
+					yield time() + wait
+
+				result = self.check_result((yield b'ZFX'))
+				self.polls += 1
+				if result:
+					now = time()
+
+					self.busy = False
+					r = self.last_job
+					job_duration = now - self.job_started
+					last_busy = self.last_busy
+					yield self.put_job()
+
+					if self.job_duration:
+						self.job_duration = self.job_duration * 0.8 + job_duration * 0.2
 					else:
-						result = self.check_result()
-						if result:
-							now = time()
-							
-							self.busy = False
-							r = self.last_job
-							job_duration = now - self.job_started
-							self.put_job()
-	
-							self.min_interval = min(self.min_interval, job_duration)
-	
-							iterations += 4294967296
-							t = now - last_rated
-							if t > self.options.rate:
-								self.update_rate(now, iterations, t, targetQ)
-								last_rated = now; iterations = 0
-
-							if result != b'NO-NONCE\n':
-								r.nonces = result
-								self.switch.put(r)
-	
-							sleep(self.min_interval - (CHECK_INTERVAL * 2))
-						else:
-							if result is None:
-								self.check_interval = min(self.check_interval * 2, 1)
-	
-					sleep(self.check_interval)
-			except Exception:
-				say_exception()
-				if self.device:
-					self.device.close()
-					self.device = None
-				sleep(1)
\ No newline at end of file
+						self.job_duration = job_duration
+					self.jobs_done += 1
+					if last_busy is None:
+						self.late_polls += 1
+					elif self.busy:
+						self.idle_time += self.job_started - last_busy
+
+					iterations += 4294967296
+					t = now - last_rated
+					if t > self.options.rate:
+						self.update_rate(now, iterations, t, targetQ)
+						last_rated = now; iterations = 0
+						if self.options.verbose:
+							say_line('%s: idle at most %.1f ms per job, %.1f polls per job, %d late polls', (self.id(), self.idle_time * 1000 / max(self.jobs_done - self.late_polls, 1), float(self.polls) / self.jobs_done, self.late_polls))
+
+					if result != b'NO-NONCE\n':
+						r.nonces = result
+						self.switch.put(r)
+					continue
+				elif result is False:
+					self.last_busy = time()
+				else:
+					self.check_interval = min(self.check_interval * 2, 1)
+
+			yield time() + self.check_interval
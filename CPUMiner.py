@@ -0,0 +1,123 @@
+from Miner import Miner
+from Queue import Empty
+from detect import WINDOWS
+from log import say_line
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from sha256 import partial, calculateF, search
+from time import time
+from util import uint32, Object, bytereverse
+import numpy as np
+import signal
+
+CHUNK_SIZE = 0x4000
+
+
+def initialize(options):
+	if not options.cpu:
+		return []
+	return [CPUMiner(0, options)]
+
+def init_worker():
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def scan(args):
+	(state, state2, f, merkle_end, time_, difficulty, base) = args
+	nonces = (np.arange(CHUNK_SIZE, dtype=np.uint64) + base).astype(np.uint32)
+	return search(state, state2, f, merkle_end, time_, difficulty, nonces)
+
+
+class CPUMiner(Miner):
+	def __init__(self, device_index, options):
+		super(CPUMiner, self).__init__(device_index, options)
+		self.output_size = 0x100
+		self.workers = options.cpu_workers or cpu_count()
+
+	def id(self):
+		return 'CPU:' + str(self.device_index)
+
+	def nonce_generator(self, nonces):
+		for i in xrange(self.output_size):
+			if nonces[i]:
+				yield nonces[i]
+
+	def mining_thread(self):
+		say_line('started CPU miner with %d workers', self.workers)
+
+		# windows can't fork, a process pool would rerun poclbm.py in every worker
+		if WINDOWS:
+			pool = ThreadPool(self.workers)
+		else:
+			pool = Pool(self.workers, init_worker)
+		try:
+			self.mine(pool)
+		finally:
+			pool.terminate()
+
+	def mine(self, pool):
+		last_rated = last_n_time = time()
+		base = threads_run = 0
+		output = np.zeros(self.output_size + 1, np.uint32)
+
+		work = None
+		while not self.should_stop:
+			if (not work) or (not self.work_queue.empty()):
+				try:
+					work = self.work_queue.get(True, 1)
+				except Empty: continue
+				else:
+					if not work: continue
+					nonces_left = 0xFFFFFFFF
+					state = work.state
+					state2 = work.state2
+					f = work.f
+
+			bases = [uint32(base + i * CHUNK_SIZE) for i in xrange(self.workers)]
+			found = pool.map(scan, [(state, state2, f, work.merkle_end, work.time, work.difficulty, b) for b in bases])
+
+			nonces_left -= self.workers * CHUNK_SIZE
+			threads_run += self.workers * CHUNK_SIZE
+			base = uint32(base + self.workers * CHUNK_SIZE)
+
+			for nonces in found:
+				for nonce in nonces:
+					output[self.output_size] = output[(nonce >> 2) & (self.output_size - 1)] = nonce
+
+			if output[self.output_size]:
+				result = Object()
+				result.header = work.header
+				result.merkle_end = work.merkle_end
+				result.time = work.time
+				result.difficulty = work.difficulty
+				result.target = work.target
+				result.state = np.array(state)
+				result.nonces = np.array(output)
+				result.job_id = work.job_id
+				result.extranonce2 = work.extranonce2
+				result.server = work.server
+				result.miner = self
+				self.switch.put(result)
+				output.fill(0)
+
+			now = time()
+			t = now - last_rated
+			if t > self.options.rate:
+				self.update_rate(now, threads_run, t, work.targetQ)
+				last_rated = now; threads_run = 0
+
+			if not self.switch.update_time:
+				if nonces_left < 3 * self.workers * CHUNK_SIZE:
+					self.request_work()
+					nonces_left += 0xFFFFFFFFFFFF
+				elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
+					say_line('warning: job finished, %s is idle', self.id())
+					work = None
+			elif now - last_n_time > 1:
+				work.time = bytereverse(bytereverse(work.time) + 1)
+				state2 = partial(state, work.merkle_end, work.time, work.difficulty, f)
+				calculateF(state, work.merkle_end, work.time, work.difficulty, f, state2)
+				last_n_time = now
+				self.update_time_counter += 1
+				if self.update_time_counter >= self.switch.max_update_time:
+					self.request_work()
+					self.update_time_counter = 1
@@ -0,0 +1,112 @@
+from log import say_exception
+from select import select
+from threading import Lock
+from time import time
+import httplib
+import socket
+import socks
+
+MAX_IDLE = 8
+IDLE_TIMEOUT = 60
+
+
+class ConnectionPool(object):
+	def __init__(self):
+		self.lock = Lock()
+		self.idle = {}
+
+		self.opened = self.reused = self.stale = 0
+		self.setup_time = 0
+
+	def key(self, proto, host, proxy):
+		if proxy:
+			return (proto, host, proxy.proto, proxy.user, proxy.pwd, proxy.host)
+		return (proto, host)
+
+	def get(self, proto, host, proxy):
+		key = self.key(proto, host, proxy)
+		while True:
+			with self.lock:
+				idle = self.idle.get(key)
+				if not idle:
+					break
+				connection, last_used = idle.pop()
+			if self.usable(connection, last_used):
+				with self.lock:
+					self.reused += 1
+				return connection
+			with self.lock:
+				self.stale += 1
+			connection.close()
+
+		start = time()
+		connection = self.connect(proto, host, proxy)
+		with self.lock:
+			self.opened += 1
+			self.setup_time += time() - start
+		connection.pool_key = key
+		return connection
+
+	def put(self, connection):
+		if not connection or not connection.sock:
+			return
+		connection.sock.settimeout(None)
+		with self.lock:
+			idle = self.idle.setdefault(connection.pool_key, [])
+			idle.append((connection, time()))
+			while len(idle) > MAX_IDLE:
+				idle.pop(0)[0].close()
+
+	def clear(self, proto, host, proxy):
+		with self.lock:
+			idle = self.idle.pop(self.key(proto, host, proxy), [])
+		for connection, last_used in idle:
+			connection.close()
+
+	def usable(self, connection, last_used):
+		# an idle keep-alive socket should have nothing to read, anything readable means the server closed it
+		if not connection.sock or time() - last_used > IDLE_TIMEOUT:
+			return False
+		try:
+			return not select([connection.sock], [], [], 0)[0]
+		except (socket.error, ValueError):
+			return False
+
+	def connect(self, proto, host, proxy):
+		if proto == 'https': connector = httplib.HTTPSConnection
+		else: connector = httplib.HTTPConnection
+
+		connection = connector(host, strict=True)
+		if not proxy:
+			connection.connect()
+		else:
+			host, port = host.split(':')
+
+			proxy_port = 9050
+			proxy_host = proxy.host.split(':')
+			if len(proxy_host) > 1:
+				proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
+
+			connection.sock = socks.socksocket()
+
+			proxy_type = socks.PROXY_TYPE_SOCKS5
+			if proxy.proto == 'http':
+				proxy_type = socks.PROXY_TYPE_HTTP
+			elif proxy.proto == 'socks4':
+				proxy_type = socks.PROXY_TYPE_SOCKS4
+
+			connection.sock.setproxy(proxy_type, proxy_host, proxy_port, True, proxy.user, proxy.pwd)
+			try:
+				connection.sock.connect((host, int(port)))
+			except socks.Socks5AuthError:
+				say_exception('Proxy error:')
+				connection.close()
+				raise
+
+		# headers and body go out in separate sends, don't let Nagle hold back the body
+		connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return connection
+
+	def stats(self):
+		with self.lock:
+			return '%d connections opened (%.1f ms average setup), %d reused, %d stale' % (self.opened, self.setup_time * 1000 / max(self.opened, 1), self.reused, self.stale)
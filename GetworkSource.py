@@ -1,3 +1,5 @@
+from ConnectionPool import ConnectionPool
+from Queue import Queue, Empty
 from Source import Source
 from base64 import b64encode
 from httplib import HTTPException
@@ -13,7 +15,10 @@ import socket
 import socks
 
 
+SUBMIT_THREADS = 4
 
+# shared by every GetworkSource, connections are keyed by server and proxy
+pool = ConnectionPool()
 
 
 class NotAuthorized(Exception): pass
@@ -23,7 +28,7 @@ class GetworkSource(Source):
 	def __init__(self, switch):
 		super(GetworkSource, self).__init__(switch)
 
-		self.connection = self.lp_connection = None
+		self.lp_connection = None
 		self.long_poll_timeout = 3600
 		self.max_redirects = 3
 
@@ -35,6 +40,9 @@ class GetworkSource(Source):
 
 		self.authorization_failed = False
 
+		self.submit_queue = Queue()
+		self.submit_threads = []
+
 	def loop(self):
 		if self.authorization_failed: return
 		super(GetworkSource, self).loop()
@@ -43,6 +51,8 @@ class GetworkSource(Source):
 		thread.daemon = True
 		thread.start()
 
+		self.start_submit_threads()
+
 		while True:
 			if self.should_stop: return
 
@@ -63,41 +73,6 @@ class GetworkSource(Source):
 				say_exception("Unexpected error:")
 				break
 
-	def ensure_connected(self, connection, proto, host):
-		if connection != None and connection.sock != None:
-			return connection, False
-
-		if proto == 'https': connector = httplib.HTTPSConnection
-		else: connector = httplib.HTTPConnection
-
-		if not self.options.proxy:
-			return connector(host, strict=True), True
-
-		host, port = host.split(':')
-
-		proxy_proto, user, pwd, proxy_host = self.options.proxy[:4]
-		proxy_port = 9050
-		proxy_host = proxy_host.split(':')
-		if len(proxy_host) > 1:
-			proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
-
-		connection = connector(host, strict=True)
-		connection.sock = socks.socksocket()
-
-		proxy_type = socks.PROXY_TYPE_SOCKS5
-		if proxy_proto == 'http':
-			proxy_type = socks.PROXY_TYPE_HTTP
-		elif proxy_proto == 'socks4':
-			proxy_type = socks.PROXY_TYPE_SOCKS4
-
-		connection.sock.setproxy(proxy_type, proxy_host, proxy_port, True, user, pwd)
-		try:
-			connection.sock.connect((host, int(port)))
-		except socks.Socks5AuthError:
-			say_exception('Proxy error:')
-			self.stop()
-		return connection, True
-
 	def request(self, connection, url, headers, data=None, timeout=0):
 		result = response = None
 		try:
@@ -144,16 +119,22 @@ class GetworkSource(Source):
 					response = connection.getresponse()
 				except socket.timeout:
 					pass
-			connection.sock.settimeout(timeout)
+			if connection.sock: # closed by httplib if the server asked for it
+				connection.sock.settimeout(timeout)
 			return response
 		else:
 			return connection.getresponse()
 
+	def call(self, data=None):
+		connection = pool.get(self.server().proto, self.server().host, self.options.proxy)
+		postdata = dict(self.postdata, params=if_else(data, [data], []))
+		(connection, result) = self.request(connection, '/', self.headers, dumps(postdata))
+		pool.put(connection)
+		return result
+
 	def getwork(self, data=None):
 		try:
-			self.connection = self.ensure_connected(self.connection, self.server().proto, self.server().host)[0]
-			self.postdata['params'] = if_else(data, [data], [])
-			(self.connection, result) = self.request(self.connection, '/', self.headers, dumps(self.postdata))
+			result = self.call(data)
 
 			self.switch.connection_ok()
 
@@ -165,10 +146,41 @@ class GetworkSource(Source):
 
 	def send_internal(self, result, nonce):
 		data = ''.join([result.header.encode('hex'), pack('III', long(result.time), long(result.difficulty), long(nonce)).encode('hex'), '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'])
-		accepted = self.getwork(data)
-		if accepted != None:
-			self.switch.report(result.miner, nonce, accepted)
-			return True
+		self.submit_queue.put((result, nonce, data))
+		return True
+
+	def start_submit_threads(self):
+		# started once per source, a worker may still be blocked in call() from before a restart
+		if self.submit_threads: return
+		for i in xrange(SUBMIT_THREADS):
+			thread = Thread(target=self.submit_thread)
+			thread.daemon = True
+			thread.start()
+			self.submit_threads.append(thread)
+
+	def submit_thread(self):
+		# submits run on pooled keep-alive connections, concurrently with each other and with getwork
+		while not self.switch.should_stop:
+			if self.should_stop:
+				sleep(1)
+				continue
+			try:
+				result, nonce, data = self.submit_queue.get(True, 1)
+			except Empty:
+				continue
+			try:
+				response = self.call(data)
+			except (IOError, httplib.HTTPException, ValueError, socks.ProxyError, NotAuthorized, RPCError):
+				# resubmitted after the switch gets back to this server
+				self.submit_queue.put((result, nonce, data))
+				self.stop()
+				continue
+			except Exception:
+				say_exception()
+				continue
+			self.switch.connection_ok()
+			with self.switch.lock:
+				self.switch.report(result.miner, nonce, response['result'])
 
 	def long_poll_thread(self):
 		last_host = None
@@ -188,9 +200,8 @@ class GetworkSource(Source):
 					url = url[url.find(host) + len(host):]
 					if url == '': url = '/'
 				try:
-					if host != last_host: self.close_lp_connection()
-					self.lp_connection, changed = self.ensure_connected(self.lp_connection, proto, host)
-					if changed:
+					self.lp_connection = pool.get(proto, host, self.options.proxy)
+					if host != last_host:
 						say_line("LP connected to %s", self.server().name)
 						last_host = host
 
@@ -198,7 +209,9 @@ class GetworkSource(Source):
 					response = self.request(self.lp_connection, url, self.headers, timeout=self.long_poll_timeout)
 					self.long_poll_active = False
 					if response:
-						(self.lp_connection, result) = response
+						(connection, result) = response
+						pool.put(connection)
+						self.lp_connection = None
 						self.queue_work(result['result'])
 						if self.options.verbose:
 							say_line('long poll: new block %s%s', (result['result']['data'][56:64], result['result']['data'][48:56]))
@@ -209,27 +222,34 @@ class GetworkSource(Source):
 				except Exception:
 					say_exception()
 
+	def status(self):
+		say_line('HTTP: %s', pool.stats())
+
 	def stop(self):
 		self.should_stop = True
 		self.close_lp_connection()
 		self.close_connection()
 
 	def close_connection(self):
-		if self.connection:
-			self.connection.close()
-			self.connection = None
+		pool.clear(self.server().proto, self.server().host, self.options.proxy)
 
 	def close_lp_connection(self):
 		if self.lp_connection:
 			self.lp_connection.close()
 			self.lp_connection = None
 
-	def queue_work(self, work, miner=None):
+	def queue_work(self, work, miner=None, prefetch=False):
 		if work:
 			if not 'target' in work:
 				work['target'] = '0000000000000000000000000000000000000000000000000000ffff00000000'
 
-			self.switch.queue_work(self, work['data'], work['target'], miner=miner)
+			self.switch.queue_work(self, work['data'], work['target'], miner=miner, prefetch=prefetch)
+
+	def prefetch_work(self, miner):
+		work = self.getwork()
+		if work:
+			self.queue_work(work, miner, True)
+			return True
 
 	def detect_stratum(self):
 		work = self.getwork()
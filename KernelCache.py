@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from detect import WINDOWS
+from json import dumps, loads
+from log import say_exception
+from threading import Lock, current_thread
+from time import sleep, time
+import os
+
+if WINDOWS:
+	import msvcrt
+else:
+	import fcntl
+
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'index.lock'
+KERNEL_SUFFIX = '.elf'
+
+
+def replace(source, destination):
+	try:
+		os.rename(source, destination)
+	except OSError: # windows won't rename over an existing file
+		if os.path.exists(destination):
+			os.remove(destination)
+		os.rename(source, destination)
+
+class KernelCache(object):
+	def __init__(self, directory, max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.lock = Lock()
+
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError: # created by another miner in the meantime
+				pass
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def read(self, name):
+		try:
+			cache_file = open(self.path(name), 'rb')
+			try:
+				return cache_file.read()
+			finally:
+				cache_file.close()
+		except IOError:
+			return None
+
+	def write(self, name, data):
+		temp_name = self.path('%s.%d.%d.tmp' % (name, os.getpid(), current_thread().ident))
+		try:
+			cache_file = open(temp_name, 'wb')
+			try:
+				cache_file.write(data)
+			finally:
+				cache_file.close()
+			replace(temp_name, self.path(name))
+		except (IOError, OSError):
+			say_exception('Unable to write %s to kernel cache:' % name)
+			if os.path.exists(temp_name):
+				os.remove(temp_name)
+
+	@contextmanager
+	def locked(self):
+		# the thread lock covers miners in this process, the lock file other processes sharing the directory
+		with self.lock:
+			lock_file = open(self.path(LOCK_NAME), 'a+b')
+			try:
+				if WINDOWS:
+					while True:
+						try:
+							lock_file.seek(0)
+							msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+							break
+						except IOError: # gives up after ten seconds
+							sleep(0.1)
+					try:
+						yield
+					finally:
+						lock_file.seek(0)
+						msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+				else:
+					fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+					yield
+			finally:
+				lock_file.close()
+
+	def read_index(self):
+		try:
+			return loads(self.read(INDEX_NAME) or '{}')
+		except ValueError:
+			return {}
+
+	def load(self, name):
+		data = self.read(name)
+		if data is None:
+			return None
+		with self.locked():
+			index = self.read_index()
+			metadata = index.setdefault(name, {'size': len(data)})
+			metadata['last_used'] = time()
+			self.write(INDEX_NAME, dumps(index))
+		return data, metadata
+
+	def store(self, name, data, metadata):
+		self.write(name, data)
+		with self.locked():
+			index = self.read_index()
+			metadata = dict(metadata, size=len(data), last_used=time())
+			index[name] = metadata
+			self.evict(index, name)
+			self.write(INDEX_NAME, dumps(index))
+
+	def evict(self, index, keep):
+		# binaries missing from the index, e.g. from an older version, still count towards the limit
+		for name in os.listdir(self.directory):
+			if name.endswith(KERNEL_SUFFIX) and name not in index:
+				try:
+					index[name] = {'size': os.path.getsize(self.path(name)), 'last_used': os.path.getmtime(self.path(name))}
+				except OSError:
+					pass
+		for name in index.keys():
+			if not os.path.exists(self.path(name)):
+				del index[name]
+
+		total = sum([entry['size'] for entry in index.itervalues()])
+		for name in sorted(index, key=lambda name: index[name]['last_used']):
+			if total <= self.max_size:
+				break
+			if name == keep:
+				continue
+			total -= index[name]['size']
+			del index[name]
+			try:
+				os.remove(self.path(name))
+			except OSError:
+				pass
@@ -1,8 +1,25 @@
-from Queue import Queue
-from decimal import Decimal
+from Queue import Queue, Empty
+from collections import deque
+from log import say_exception
 from threading import Thread
 from time import time
 
+RATE_WINDOWS = (60, 900, 3600)
+
+
+class RateWindow(object):
+	def __init__(self, length):
+		self.length = length
+		self.samples = deque()
+
+	def update(self, now, accepted):
+		# samples are (time, accepted) where the accepted count changed, plus the latest one
+		if self.samples and self.samples[-1][1] == accepted:
+			self.samples.pop()
+		self.samples.append((now, accepted))
+		while self.samples[0][0] < now - self.length:
+			self.samples.popleft()
+		return accepted - self.samples[0][1]
 
 class Miner(object):
 	def __init__(self, device_index, options):
@@ -12,12 +29,18 @@ class Miner(object):
 		self.update_time_counter = 1
 		self.share_count = [0, 0]
 		self.work_queue = Queue()
+		self.ready_queue = Queue()
 
 		self.update = True
 
-		self.accept_hist = []
+		self.rate_windows = [RateWindow(length) for length in sorted(set(RATE_WINDOWS + (options.estimate,)))]
+		self.estimated_rates = {}
 		self.rate = self.estimated_rate = 0
 
+		self.stale_shares = self.hardware_errors = 0
+		self.temperature = None
+		self.work_time = None
+
 	def start(self):
 		self.should_stop = False
 		Thread(target=self.mining_thread).start()
@@ -27,18 +50,34 @@ class Miner(object):
 		if message: print '\n%s' % message
 		self.should_stop = True
 
+	def request_work(self):
+		try:
+			ready = self.ready_work() or self.switch.local_work(self)
+		except Exception:
+			say_exception('Local work error:')
+			ready = False
+		if not ready:
+			self.update = True
+			self.switch.wakeup_source()
+		self.switch.prefetch_event.set()
+
+	def ready_work(self):
+		while True:
+			try:
+				work = self.ready_queue.get(False)
+			except Empty:
+				return False
+			# rolled for up to max_update_time once started, older prefetched work would outlive X-Roll-NTime expiry
+			if time() - work.ready_time < self.switch.max_update_time:
+				self.work_queue.put(work)
+				self.work_time = time()
+				return True
+
 	def update_rate(self, now, iterations, t, targetQ, rate_divisor=1000):
-		self.rate = int((iterations / t) / rate_divisor)
-		self.rate = Decimal(self.rate) / 1000
-		if self.accept_hist:
-			LAH = self.accept_hist.pop()
-			if LAH[1] != self.share_count[1]:
-				self.accept_hist.append(LAH)
-		self.accept_hist.append((now, self.share_count[1]))
-		while (self.accept_hist[0][0] < now - self.options.estimate):
-			self.accept_hist.pop(0)
-		new_accept = self.share_count[1] - self.accept_hist[0][1]
-		self.estimated_rate = Decimal(new_accept) * (targetQ) / min(int(now - self.start_time), self.options.estimate) / 1000
-		self.estimated_rate = Decimal(self.estimated_rate) / 1000
-
-		self.switch.status_updated(self)
\ No newline at end of file
+		# rates are in MH/s
+		self.rate = iterations / t / rate_divisor / 1000.0
+		elapsed = max(now - self.start_time, 1)
+		for window in self.rate_windows:
+			new_accept = window.update(now, self.share_count[1])
+			self.estimated_rates[window.length] = float(new_accept) * targetQ / min(elapsed, window.length) / 1000000
+		self.estimated_rate = self.estimated_rates[self.options.estimate]
\ No newline at end of file
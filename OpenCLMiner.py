@@ -1,12 +1,15 @@
+from KernelCache import KernelCache, KERNEL_SUFFIX
 from Miner import Miner
 from Queue import Empty
+from collections import deque
 from hashlib import md5
+from json import dumps, loads
 from log import say_line
 from sha256 import partial, calculateF
 from struct import pack
 from threading import Lock
 from time import sleep, time
-from util import if_else, uint32, Object, bytereverse, patch, tokenize
+from util import if_else, uint32, Object, bytereverse, patch, tokenize, parallel
 import numpy as np
 import sys
 
@@ -59,18 +62,73 @@ if OPENCL:
 else:
 	print "\nNot using OpenCL\n"
 
+JOB_SIZE = 19
+
+AUTOTUNE_FRAMES = (15, 30, 60)
+AUTOTUNE_WORKSIZES = (32, 64, 128, 256, 512, 1024)
+AUTOTUNE_TIME = 1
+
+def job_arguments(state, state2, f):
+	return np.concatenate((state, state2[[1, 2, 3, 5, 6, 7]], f[:5])).astype(np.uint32)
+
+adapters = None
+
 def shutdown():
 	if ADL:
 		ADL_Main_Control_Destroy()
 
+def get_adapter_info():
+	adapter_info = []
+	num_adapters = c_int(-1)
+	if ADL_Adapter_NumberOfAdapters_Get(byref(num_adapters)) != ADL_OK:
+		say_line("ADL_Adapter_NumberOfAdapters_Get failed, cutoff temperature disabled")
+		return
+
+	AdapterInfoArray = (AdapterInfo * num_adapters.value)()
+
+	if ADL_Adapter_AdapterInfo_Get(cast(AdapterInfoArray, LPAdapterInfo), sizeof(AdapterInfoArray)) != ADL_OK:
+		say_line("ADL_Adapter_AdapterInfo_Get failed, cutoff temperature disabled")
+		return
+
+	deviceAdapter = namedtuple('DeviceAdapter', ['AdapterIndex', 'AdapterID', 'BusNumber', 'UDID'])
+	devices = []
+
+	for adapter in AdapterInfoArray:
+		index = adapter.iAdapterIndex
+		busNum = adapter.iBusNumber
+		udid = adapter.strUDID
+
+		adapterID = c_int(-1)
+
+		if ADL_Adapter_ID_Get(index, byref(adapterID)) != ADL_OK:
+			say_line("ADL_Adapter_Active_Get failed, cutoff temperature disabled")
+			return
+
+		found = False
+		for device in devices:
+			if (device.AdapterID.value == adapterID.value):
+				found = True
+				break
+
+		if (found == False):
+			devices.append(deviceAdapter(index, adapterID, busNum, udid))
+
+	for device in devices:
+		adapter_info.append(AdapterInfoArray[device.AdapterIndex])
+
+	return adapter_info
+
 
 def initialize(options):
+	global adapters
+
 	if not OPENCL:
 		return []
 
 	options.worksize = tokenize(options.worksize, 'worksize')
 	options.frames = tokenize(options.frames, 'frames', [30])
 	options.frameSleep = tokenize(options.frameSleep, 'frameSleep', cast=float)
+	options.pipeline = tokenize(options.pipeline, 'pipeline', [2])
 	options.vectors = if_else(options.old_vectors, [True], tokenize(options.vectors, 'vectors', [False], bool))
 
 	platforms = cl.get_platforms()
@@ -84,6 +142,7 @@ def initialize(options):
 	if options.platform == -1:
 		options.platform = 0
 
+	start = time()
 	devices = platforms[options.platform].get_devices()
 
 	if not options.device and devices:
@@ -92,41 +151,77 @@ def initialize(options):
 			print '[%d]\t%s' % (i, devices[i].name)
 		print '\nNo devices specified, using all GPU devices\n'
 
-	miners = [
-		OpenCLMiner(i, options)
-		for i in xrange(len(devices))
+	adapters_start = time()
+	if ADL:
+		with adl_lock:
+			adapters = get_adapter_info()
+	adapters_time = time() - adapters_start
+
+	selected = [
+		i for i in xrange(len(devices))
 		if (
 			(not options.device and devices[i].type == cl.device_type.GPU) or
 			(i in options.device)
 		)
 	]
-
-	for i in xrange(len(miners)):
-		miners[i].worksize = options.worksize[min(i, len(options.worksize) - 1)]
-		miners[i].frames = options.frames[min(i, len(options.frames) - 1)]
-		miners[i].frameSleep = options.frameSleep[min(i, len(options.frameSleep) - 1)]
-		miners[i].vectors = options.vectors[min(i, len(options.vectors) - 1)]
-		miners[i].cutoff_temp = options.cutoff_temp[min(i, len(options.cutoff_temp) - 1)]
-		miners[i].cutoff_interval = options.cutoff_interval[min(i, len(options.cutoff_interval) - 1)]
+	created = parallel(lambda i: OpenCLMiner(i, options, devices[i]), selected)
+	discovery_time = time() - start - adapters_time
+
+	kernel_cache = KernelCache(options.kernel_cache, options.kernel_cache_size * 1024 * 1024)
+
+	# per device options follow the order devices were selected in, even if one of them failed
+	miners = []
+	for i in xrange(len(created)):
+		miner = created[i]
+		if not miner:
+			say_line('Skipping OpenCL device %d, see the error above', selected[i])
+			continue
+		miner.kernel_cache = kernel_cache
+		miner.worksize = options.worksize[min(i, len(options.worksize) - 1)]
+		miner.frames = options.frames[min(i, len(options.frames) - 1)]
+		miner.frameSleep = options.frameSleep[min(i, len(options.frameSleep) - 1)]
+		miner.pipeline = max(options.pipeline[min(i, len(options.pipeline) - 1)], 1)
+		miner.vectors = options.vectors[min(i, len(options.vectors) - 1)]
+		miner.cutoff_temp = options.cutoff_temp[min(i, len(options.cutoff_temp) - 1)]
+		miner.cutoff_interval = options.cutoff_interval[min(i, len(options.cutoff_interval) - 1)]
+		miners.append(miner)
+
+	build_start = time()
+	if not options.warm_kernel_cache:
+		parallel(OpenCLMiner.prepare, miners)
+	build_time = time() - build_start
+
+	say_line('OpenCL startup: discovery %.2fs, adapter info %.2fs, kernel builds %.2fs', (discovery_time, adapters_time, build_time))
 	return miners
 
+def warm_kernel_cache(miners):
+	def warm(miner):
+		for vectors in (False, True):
+			miner.vectors = vectors
+			miner.set_defines()
+			miner.load_kernel()
+		say_line('kernel cache is warm for %s', miner.id())
+	parallel(warm, miners)
+
 
 class OpenCLMiner(Miner):
-	def __init__(self, device_index, options):
+	def __init__(self, device_index, options, device=None):
 		super(OpenCLMiner, self).__init__(device_index, options)
 		self.output_size = 0x100
 
-		self.device = cl.get_platforms()[options.platform].get_devices()[device_index]
+		self.device = device or cl.get_platforms()[options.platform].get_devices()[device_index]
 		self.device_name = self.device.name.strip('\r\n \x00\t')
 		self.frames = 30
+		self.pipeline = 2
 
 		self.worksize = self.frameSleep= self.rate = self.estimated_rate = 0
 		self.vectors = False
 
 		self.adapterIndex = None
-		if ADL and 'amd' in self.device.platform.name.lower() and self.device.type == cl.device_type.GPU:
-			with adl_lock:
-				self.adapterIndex = self.get_adapter_info()[self.device_index].iAdapterIndex
+		if adapters and 'amd' in self.device.platform.name.lower() and self.device.type == cl.device_type.GPU:
+			self.adapterIndex = adapters[self.device_index].iAdapterIndex
+
+		self.prepared = False
 
 	def id(self):
 		return str(self.options.platform) + ':' + str(self.device_index) + ':' + self.device_name
@@ -140,11 +235,10 @@ class OpenCLMiner(Miner):
 	def mining_thread(self):
 		say_line('started OpenCL miner on platform %d, device %d (%s)', (self.options.platform, self.device_index, self.device_name))
 
-		(self.defines, rate_divisor, hashspace) = if_else(self.vectors, ('-DVECTORS', 500, 0x7FFFFFFF), ('', 1000, 0xFFFFFFFF))
-		self.defines += (' -DOUTPUT_SIZE=' + str(self.output_size))
-		self.defines += (' -DOUTPUT_MASK=' + str(self.output_size - 1))
+		if not self.prepared:
+			self.prepare()
+		(rate_divisor, hashspace) = self.prepared
 
-		self.load_kernel()
 		frame = 1.0 / max(self.frames, 3)
 		unit = self.worksize * 256
 		global_threads = unit * 10
@@ -153,9 +247,12 @@ class OpenCLMiner(Miner):
 
 		last_rated_pace = last_rated = last_n_time = last_temperature = time()
 		base = last_hash_rate = threads_run_pace = threads_run = 0
-		output = np.zeros(self.output_size + 1, np.uint32)
-		output_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR, hostbuf=output)
-		self.kernel.set_arg(20, output_buffer)
+		outputs = [np.zeros(self.output_size + 1, np.uint32) for i in xrange(self.pipeline)]
+		output_buffers = [cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR, hostbuf=output) for output in outputs]
+		pending = deque()
+		current = 0
+		job_buffer = cl.Buffer(self.context, cl.mem_flags.READ_ONLY, JOB_SIZE * 4)
+		self.kernel.set_arg(0, job_buffer)
 
 		work = None
 		temperature = 0
@@ -165,6 +262,8 @@ class OpenCLMiner(Miner):
 			sleep(self.frameSleep)
 
 			if (not work) or (not self.work_queue.empty()):
+				if not work:
+					self.read_outputs(queue, pending, outputs, output_buffers, 0)
 				try:
 					work = self.work_queue.get(True, 1)
 				except Empty: continue
@@ -175,31 +274,15 @@ class OpenCLMiner(Miner):
 					state2 = work.state2
 					f = work.f
 
-					self.kernel.set_arg(0, state[0])
-					self.kernel.set_arg(1, state[1])
-					self.kernel.set_arg(2, state[2])
-					self.kernel.set_arg(3, state[3])
-					self.kernel.set_arg(4, state[4])
-					self.kernel.set_arg(5, state[5])
-					self.kernel.set_arg(6, state[6])
-					self.kernel.set_arg(7, state[7])
-
-					self.kernel.set_arg(8, state2[1])
-					self.kernel.set_arg(9, state2[2])
-					self.kernel.set_arg(10, state2[3])
-					self.kernel.set_arg(11, state2[5])
-					self.kernel.set_arg(12, state2[6])
-					self.kernel.set_arg(13, state2[7])
-
-					self.kernel.set_arg(15, f[0])
-					self.kernel.set_arg(16, f[1])
-					self.kernel.set_arg(17, f[2])
-					self.kernel.set_arg(18, f[3])
-					self.kernel.set_arg(19, f[4])
+					# pyopencl holds the host array until the non-blocking write is done, the in-order queue runs it before the next kernel
+					cl.enqueue_write_buffer(queue, job_buffer, job_arguments(state, state2, f), is_blocking=False)
 
 			if temperature < self.cutoff_temp:
-				self.kernel.set_arg(14, pack('I', base))
+				self.kernel.set_arg(1, pack('I', base))
+				self.kernel.set_arg(2, output_buffers[current])
 				cl.enqueue_nd_range_kernel(queue, self.kernel, (global_threads,), (self.worksize,))
+				pending.append((current, cl.enqueue_read_buffer(queue, output_buffers[current], outputs[current], is_blocking=False), work, work.time))
+				current = (current + 1) % self.pipeline
 
 				nonces_left -= global_threads
 				threads_run_pace += global_threads
@@ -208,6 +291,7 @@ class OpenCLMiner(Miner):
 			else:
 				threads_run_pace = 0
 				last_rated_pace = time()
+				self.read_outputs(queue, pending, outputs, output_buffers, 0)
 				sleep(self.cutoff_interval)
 
 			now = time()
@@ -216,7 +300,7 @@ class OpenCLMiner(Miner):
 				if temperature >= self.cutoff_temp or t > 1:
 					last_temperature = now
 					with adl_lock:
-						temperature = self.get_temperature()
+						temperature = self.temperature = self.get_temperature()
 
 			t = now - last_rated_pace
 			if t > 1:
@@ -232,30 +316,11 @@ class OpenCLMiner(Miner):
 				self.update_rate(now, threads_run, t, work.targetQ, rate_divisor)
 				last_rated = now; threads_run = 0
 
-			queue.finish()
-			cl.enqueue_read_buffer(queue, output_buffer, output)
-			queue.finish()
-
-			if output[self.output_size]:
-				result = Object()
-				result.header = work.header
-				result.merkle_end = work.merkle_end
-				result.time = work.time
-				result.difficulty = work.difficulty
-				result.target = work.target
-				result.state = np.array(state)
-				result.nonces = np.array(output)
-				result.job_id = work.job_id
-				result.extranonce2 = work.extranonce2
-				result.server = work.server
-				result.miner = self
-				self.switch.put(result)
-				output.fill(0)
-				cl.enqueue_write_buffer(queue, output_buffer, output)
+			self.read_outputs(queue, pending, outputs, output_buffers, self.pipeline - 1)
 
 			if not self.switch.update_time:
 				if nonces_left < 3 * global_threads * self.frames:
-					self.update = True
+					self.request_work()
 					nonces_left += 0xFFFFFFFFFFFF
 				elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
 					say_line('warning: job finished, %s is idle', self.id()) 
@@ -264,23 +329,109 @@ class OpenCLMiner(Miner):
 				work.time = bytereverse(bytereverse(work.time) + 1)
 				state2 = partial(state, work.merkle_end, work.time, work.difficulty, f)
 				calculateF(state, work.merkle_end, work.time, work.difficulty, f, state2)
-				self.kernel.set_arg(8, state2[1])
-				self.kernel.set_arg(9, state2[2])
-				self.kernel.set_arg(10, state2[3])
-				self.kernel.set_arg(11, state2[5])
-				self.kernel.set_arg(12, state2[6])
-				self.kernel.set_arg(13, state2[7])
-				self.kernel.set_arg(15, f[0])
-				self.kernel.set_arg(16, f[1])
-				self.kernel.set_arg(17, f[2])
-				self.kernel.set_arg(18, f[3])
-				self.kernel.set_arg(19, f[4])
+				cl.enqueue_write_buffer(queue, job_buffer, job_arguments(state, state2, f), is_blocking=False)
 				last_n_time = now
 				self.update_time_counter += 1
 				if self.update_time_counter >= self.switch.max_update_time:
-					self.update = True
+					self.request_work()
 					self.update_time_counter = 1
 
+	def prepare(self):
+		if self.options.autotune:
+			self.autotune()
+		settings = self.set_defines()
+		self.load_kernel()
+		self.prepared = settings
+
+	def set_defines(self):
+		(self.defines, rate_divisor, hashspace) = if_else(self.vectors, ('-DVECTORS', 500, 0x7FFFFFFF), ('', 1000, 0xFFFFFFFF))
+		self.defines += (' -DOUTPUT_SIZE=' + str(self.output_size))
+		self.defines += (' -DOUTPUT_MASK=' + str(self.output_size - 1))
+		return rate_divisor, hashspace
+
+	def autotune(self):
+		m = md5(); m.update(''.join([self.device.platform.name, self.device.platform.version, self.device.name, self.device.driver_version]))
+		tune_name = '%s.tune' % m.hexdigest()
+		try:
+			tuned = loads(self.kernel_cache.read(tune_name) or '')
+		except ValueError:
+			say_line('%s: autotuning, this will take a moment', self.id())
+			tuned = self.sweep()
+			self.kernel_cache.write(tune_name, dumps(tuned))
+
+		self.worksize = tuned['worksize']
+		self.vectors = tuned['vectors']
+		self.frames = tuned['frames']
+		say_line('%s: tuned to worksize %d, vectors %s, frames %d (%.03f MH/s, %.1f ms latency)', (self.id(), self.worksize, self.vectors, self.frames, tuned['rate'], tuned['latency']))
+
+	def sweep(self):
+		results = []
+		for vectors in (False, True):
+			self.vectors = vectors
+			rate_divisor = self.set_defines()[0]
+			for worksize in AUTOTUNE_WORKSIZES:
+				if worksize > self.device.max_work_group_size: break
+				self.worksize = worksize
+				self.load_kernel()
+				for frames in AUTOTUNE_FRAMES:
+					rate, latency = self.measure(frames, rate_divisor)
+					if self.options.verbose:
+						say_line('%s: worksize %d, vectors %s, frames %d: %.03f MH/s, %.1f ms latency', (self.id(), worksize, vectors, frames, rate, latency))
+					results.append({'worksize': worksize, 'vectors': vectors, 'frames': frames, 'rate': rate, 'latency': latency})
+
+		# prefer the least desktop lag among settings within 1% of the best rate
+		best_rate = max([r['rate'] for r in results])
+		return max([r for r in results if r['rate'] >= best_rate * 0.99], key=lambda r: (r['frames'], -r['latency']))
+
+	def measure(self, frames, rate_divisor):
+		queue = cl.CommandQueue(self.context)
+		output = np.zeros(self.output_size + 1, np.uint32)
+		output_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR, hostbuf=output)
+		job_buffer = cl.Buffer(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=np.zeros(JOB_SIZE, np.uint32))
+		self.kernel.set_arg(0, job_buffer)
+		self.kernel.set_arg(2, output_buffer)
+
+		frame = 1.0 / frames
+		unit = self.worksize * 256
+		global_threads = unit * 10
+		base = threads_run = iterations = latency = 0
+		start = time()
+		while time() - start < AUTOTUNE_TIME:
+			before = time()
+			self.kernel.set_arg(1, pack('I', base))
+			cl.enqueue_nd_range_kernel(queue, self.kernel, (global_threads,), (self.worksize,))
+			cl.enqueue_read_buffer(queue, output_buffer, output)
+			t = time() - before
+
+			latency += t; iterations += 1
+			threads_run += global_threads
+			base = uint32(base + global_threads)
+			global_threads = max(unit * int((global_threads / t) * frame / unit), unit)
+
+		return (threads_run / (time() - start)) / rate_divisor / 1000, latency / iterations * 1000
+
+	def read_outputs(self, queue, pending, outputs, output_buffers, keep):
+		while len(pending) > keep:
+			index, event, work, work_time = pending.popleft()
+			event.wait()
+			output = outputs[index]
+			if output[self.output_size]:
+				result = Object()
+				result.header = work.header
+				result.merkle_end = work.merkle_end
+				result.time = work_time
+				result.difficulty = work.difficulty
+				result.target = work.target
+				result.state = np.array(work.state)
+				result.nonces = np.array(output)
+				result.job_id = work.job_id
+				result.extranonce2 = work.extranonce2
+				result.server = work.server
+				result.miner = self
+				self.switch.put(result)
+				output.fill(0)
+				cl.enqueue_write_buffer(queue, output_buffers[index], output, is_blocking=False)
+
 	def load_kernel(self):
 		self.context = cl.Context([self.device], None, None)
 		if (self.device.extensions.find('cl_amd_media_ops') != -1):
@@ -305,21 +456,29 @@ class OpenCLMiner(Miner):
 		kernel = kernel_file.read()
 		kernel_file.close()
 		m = md5(); m.update(''.join([self.device.platform.name, self.device.platform.version, self.device.name, self.defines, kernel]))
-		cache_name = '%s.elf' % m.hexdigest()
-		binary = None
-		try:
-			binary = open(cache_name, 'rb')
-			self.program = cl.Program(self.context, [self.device], [binary.read()]).build(self.defines)
-		except (IOError, cl.LogicError):
+		cache_name = m.hexdigest() + KERNEL_SUFFIX
+		start = time()
+		self.program = None
+		cached = self.kernel_cache.load(cache_name)
+		if cached:
+			binary, metadata = cached
+			try:
+				self.program = cl.Program(self.context, [self.device], [binary]).build(self.defines)
+				load_time = time() - start
+				if 'build_time' in metadata:
+					say_line('%s: kernel loaded from cache in %.2fs, saved %.2fs', (self.id(), load_time, metadata['build_time'] - load_time))
+			except cl.LogicError:
+				self.program = None
+		if not self.program:
 			self.program = cl.Program(self.context, kernel).build(self.defines)
 			if (self.defines.find('-DBFI_INT') != -1):
 				patchedBinary = patch(self.program.binaries[0])
 				self.program = cl.Program(self.context, [self.device], [patchedBinary]).build(self.defines)
-			binaryW = open(cache_name, 'wb')
-			binaryW.write(self.program.binaries[0])
-			binaryW.close()
-		finally:
-			if binary: binary.close()
+			self.kernel_cache.store(cache_name, self.program.binaries[0], {
+				'platform': self.device.platform.name,
+				'device': self.device_name,
+				'defines': self.defines,
+				'build_time': time() - start})
 
 		self.kernel = self.program.search
 
@@ -333,44 +492,3 @@ class OpenCLMiner(Miner):
 		if ADL_Overdrive5_Temperature_Get(self.adapterIndex, 0, byref(temperature)) == ADL_OK:
 			return temperature.iTemperature/1000.0
 		return 0
-
-	def get_adapter_info(self):
-		adapter_info = []
-		num_adapters = c_int(-1)
-		if ADL_Adapter_NumberOfAdapters_Get(byref(num_adapters)) != ADL_OK:
-			say_line("ADL_Adapter_NumberOfAdapters_Get failed, cutoff temperature disabled for %s", self.id())
-			return
-
-		AdapterInfoArray = (AdapterInfo * num_adapters.value)()
-
-		if ADL_Adapter_AdapterInfo_Get(cast(AdapterInfoArray, LPAdapterInfo), sizeof(AdapterInfoArray)) != ADL_OK:
-			say_line("ADL_Adapter_AdapterInfo_Get failed, cutoff temperature disabled for %s", self.id())
-			return
-
-		deviceAdapter = namedtuple('DeviceAdapter', ['AdapterIndex', 'AdapterID', 'BusNumber', 'UDID'])
-		devices = []
-
-		for adapter in AdapterInfoArray:
-			index = adapter.iAdapterIndex
-			busNum = adapter.iBusNumber
-			udid = adapter.strUDID
-
-			adapterID = c_int(-1)
-
-			if ADL_Adapter_ID_Get(index, byref(adapterID)) != ADL_OK:
-				say_line("ADL_Adapter_Active_Get failed, cutoff temperature disabled for %s", self.id())
-				return
-
-			found = False
-			for device in devices:
-				if (device.AdapterID.value == adapterID.value):
-					found = True
-					break
-
-			if (found == False):
-				devices.append(deviceAdapter(index, adapterID, busNum, udid))
-
-		for device in devices:
-			adapter_info.append(AdapterInfoArray[device.AdapterIndex])
-
-		return adapter_info
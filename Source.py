@@ -15,6 +15,18 @@ class Source(object):
 		self.should_stop = False
 		self.last_failback = time()
 
+	def prefetch_work(self, miner):
+		return False
+
+	def local_work(self, miner):
+		return False
+
+	def wakeup(self):
+		pass
+
+	def status(self):
+		pass
+
 	def check_failback(self):
 		if self.switch.server_index != 0 and time() - self.last_failback > self.options.failback:
 			self.stop()
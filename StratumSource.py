@@ -1,14 +1,15 @@
 from Source import Source
 from binascii import hexlify, unhexlify
+from collections import deque
 from hashlib import sha256
 from json import dumps, loads
 from log import say_exception, say_line
-from struct import pack
-from threading import Thread, Lock, Timer
-from time import sleep, time
-from util import chunks, Object
-import asynchat
-import asyncore
+from select import select
+from struct import pack, unpack
+from threading import Lock
+from time import time
+from util import chunks, if_else, Object
+import errno
 import socket
 import socks
 
@@ -17,6 +18,9 @@ import socks
 
 
 BASE_DIFFICULTY = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+REQUEST_TIMEOUT = 10
+MAX_RETRY_DELAY = 30
+RANGE_SIZE = 0x10000
 
 def detect_stratum_proxy(host):
 	s = None
@@ -47,124 +51,298 @@ def detect_stratum_proxy(host):
 		if s != None:
 			s.close()
 
+def socketpair():
+	try:
+		return socket.socketpair()
+	except AttributeError: # not available on windows
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		client.connect(listener.getsockname())
+		server = listener.accept()[0]
+		listener.close()
+		return server, client
+
+
+class Future(object):
+	def __init__(self, callback=None):
+		self.callback = callback
+		self.created = time()
+		self.done = False
+		self.result = None
+
+	def set_result(self, result):
+		self.result = result
+		self.done = True
+		if self.callback:
+			self.callback(result)
+
 
 class StratumSource(Source):
 	def __init__(self, switch):
 		super(StratumSource, self).__init__(switch)
-		self.handler = None
 		self.socket = None
-		self.channel_map = {}
-		self.subscribed = False
-		self.authorized = None
-		self.submits = {}
-		self.last_submits_cleanup = time()
+		self.read_buffer = ''
+		self.write_buffer = ''
+		self.write_queue = deque()
+		self.futures = {}
+		self.request_id = 0
+		self.last_futures_cleanup = time()
+		self.reconnect_time = None
+		self.connected_time = 0
+		self.retry_delay = 0.5
 		self.server_difficulty = BASE_DIFFICULTY
 		self.jobs = {}
 		self.current_job = None
 		self.extranonce = ''
 		self.extranonce2_size = 4
-		self.send_lock = Lock()
+		self.reservations = {}
+		self.reserve_lock = Lock()
+		self.headers_generated = 0
+		self.generation_time = 0
+
+		self.open_wakeup()
 
 	def loop(self):
 		super(StratumSource, self).loop()
+		if not self.wakeup_reader:
+			self.open_wakeup()
 
 		self.switch.update_time = True
 
-		while True:
-			if self.should_stop: return
+		try:
+			while True:
+				if self.should_stop: return
 
-			if self.current_job:
-				miner = self.switch.updatable_miner()
-				while miner:
-					self.current_job = self.refresh_job(self.current_job)
-					self.queue_work(self.current_job, miner)
+				if self.current_job:
+					miners = []
 					miner = self.switch.updatable_miner()
+					while miner:
+						miners.append(miner)
+						miner = self.switch.updatable_miner()
+					for miner in miners:
+						self.queue_work(self.refresh_jobs(miner, 1)[0], miner)
 
-			if self.check_failback():
-				return True
+				if self.check_failback():
+					return True
+
+				if self.reconnect_time and time() >= self.reconnect_time:
+					self.reconnect()
 
-			if not self.handler:
 				try:
-					#socket = ssl.wrap_socket(socket)
-					address, port = self.server().host.split(':', 1)
-
-
-					if not self.options.proxy:
-						self.socket = socket.nodelay_socket(socket.AF_INET, socket.SOCK_STREAM)
-						self.socket.connect((address, int(port)))
-					else:
-						proxy_proto, user, pwd, proxy_host = self.options.proxy[:4]
-						proxy_port = 9050
-						proxy_host = proxy_host.split(':')
-						if len(proxy_host) > 1:
-							proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
-
-						self.socket = socks.socksocket()
-				
-						proxy_type = socks.PROXY_TYPE_SOCKS5
-						if proxy_proto == 'http':
-							proxy_type = socks.PROXY_TYPE_HTTP
-						elif proxy_proto == 'socks4':
-							proxy_type = socks.PROXY_TYPE_SOCKS4
-				
-						self.socket.setproxy(proxy_type, proxy_host, proxy_port, True, user, pwd)
-						try:
-							self.socket.connect((address, int(port)))
-						except socks.Socks5AuthError:
-							say_exception('Proxy error:')
+					if not self.socket:
+						if not self.retry_wait():
+							continue
+						if not self.connect():
 							self.stop()
-
-					self.handler = Handler(self.socket, self.channel_map, self)
-					thread = Thread(target=self.asyncore_thread)
-					thread.daemon = True
-					thread.start()
-
-					if not self.subscribe():
-						say_line('Failed to subscribe')
-						self.stop()
-					elif not self.authorize():
-						self.stop()
-
-				except socket.error:
+						elif not self.subscribe():
+							say_line('Failed to subscribe')
+							self.stop()
+						elif not self.authorize():
+							self.stop()
+						continue
+
+					self.process_result_queue()
+					timeout = 1
+					if self.reconnect_time:
+						timeout = min(timeout, self.reconnect_time - time())
+					self.poll(timeout)
+				except Exception:
 					say_exception()
 					self.stop()
-					continue
+		finally:
+			self.close()
+			self.close_wakeup()
+
+	def retry_wait(self):
+		# back off when the server keeps dropping fresh connections, instead of spinning on reconnects
+		if self.connected_time:
+			if time() - self.connected_time > MAX_RETRY_DELAY:
+				self.retry_delay = 1
+			else:
+				self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY)
+			readable = select([self.wakeup_reader], [], [], self.retry_delay)[0]
+			if readable:
+				self.drain_wakeup()
+			if self.should_stop:
+				return False
+		self.connected_time = time()
+		return True
+
+	def connect(self):
+		#socket = ssl.wrap_socket(socket)
+		address, port = self.server().host.split(':', 1)
+
+		if not self.options.proxy:
+			self.socket = socket.nodelay_socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.socket.connect((address, int(port)))
+		else:
+			proxy_proto, user, pwd, proxy_host = self.options.proxy[:4]
+			proxy_port = 9050
+			proxy_host = proxy_host.split(':')
+			if len(proxy_host) > 1:
+				proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
+
+			self.socket = socks.socksocket()
+
+			proxy_type = socks.PROXY_TYPE_SOCKS5
+			if proxy_proto == 'http':
+				proxy_type = socks.PROXY_TYPE_HTTP
+			elif proxy_proto == 'socks4':
+				proxy_type = socks.PROXY_TYPE_SOCKS4
+
+			self.socket.setproxy(proxy_type, proxy_host, proxy_port, True, user, pwd)
+			try:
+				self.socket.connect((address, int(port)))
+			except socks.Socks5AuthError:
+				say_exception('Proxy error:')
+				self.close()
+				return False
 
-			with self.send_lock:
-				self.process_result_queue()
-			sleep(1)
+		self.socket.setblocking(0)
+		self.read_buffer = self.write_buffer = ''
+		self.write_queue.clear()
+		self.futures.clear()
+		return True
 
-	def asyncore_thread(self):
-		asyncore.loop(map=self.channel_map)
+	def close(self):
+		if self.socket:
+			try:
+				self.socket.close()
+			except socket.error:
+				pass
+			self.socket = None
 
 	def stop(self):
 		self.should_stop = True
-		if self.handler:
-			self.handler.close()
-
-	def refresh_job(self, j):
-		j.extranonce2 = self.increment_nonce(j.extranonce2)
-		coinbase = j.coinbase1 + self.extranonce + j.extranonce2 + j.coinbase2
-		coinbase_hash = sha256(sha256(unhexlify(coinbase)).digest()).digest()
-
-		merkle_root = coinbase_hash
-		for hash_ in j.merkle_branch:
-			merkle_root = sha256(sha256(merkle_root + unhexlify(hash_)).digest()).digest()
-		merkle_root_reversed = ''
-		for word in chunks(merkle_root, 4):
-			merkle_root_reversed += word[::-1]
-		merkle_root = hexlify(merkle_root_reversed)
-
-		j.block_header = ''.join([j.version, j.prevhash, merkle_root, j.ntime, j.nbits])
-		j.time = time()
-		return j
-		
-
-	def increment_nonce(self, nonce):
-		next_nonce = long(nonce, 16) + 1
-		if len('%x' % next_nonce) > (self.extranonce2_size * 2):
-			return '00' * self.extranonce2_size
-		return ('%0' + str(self.extranonce2_size * 2) +'x') % next_nonce
+		self.wakeup()
+
+	def open_wakeup(self):
+		self.wakeup_reader, self.wakeup_writer = socketpair()
+		self.wakeup_reader.setblocking(0)
+		self.wakeup_writer.setblocking(0)
+
+	def close_wakeup(self):
+		reader, writer = self.wakeup_reader, self.wakeup_writer
+		self.wakeup_reader = self.wakeup_writer = None
+		reader.close()
+		writer.close()
+
+	def wakeup(self):
+		writer = self.wakeup_writer
+		if not writer: return
+		try:
+			writer.send('x')
+		except socket.error: # a wakeup is already pending, or the loop has exited
+			pass
+
+	def drain_wakeup(self):
+		try:
+			self.wakeup_reader.recv(4096)
+		except socket.error:
+			pass
+
+	def poll(self, timeout):
+		while self.write_queue:
+			self.write_buffer += self.write_queue.popleft()
+
+		readable, writable = select([self.socket, self.wakeup_reader], if_else(self.write_buffer, [self.socket], []), [], max(timeout, 0))[:2]
+
+		if self.wakeup_reader in readable:
+			self.drain_wakeup()
+
+		if self.socket in writable:
+			try:
+				sent = self.socket.send(self.write_buffer)
+				self.write_buffer = self.write_buffer[sent:]
+			except socket.error, e:
+				if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+
+		if self.socket in readable:
+			data = self.socket.recv(4096)
+			if not data:
+				self.close()
+				return
+			self.read_buffer += data
+			while '\n' in self.read_buffer:
+				line, self.read_buffer = self.read_buffer.split('\n', 1)
+				if line.strip():
+					self.handle_message(loads(line))
+					if not self.socket: return
+
+	def wait(self, future, timeout):
+		end = time() + timeout
+		while not future.done and self.socket and not self.should_stop and time() < end:
+			self.poll(end - time())
+		return future.done
+
+	def prepare_job(self, j):
+		# everything but extranonce2 is fixed for a job, decode it once and hash the coinbase up to extranonce2
+		# miner threads check j.extranonce without the lock, so it is set last, once j is complete
+		with self.reserve_lock:
+			extranonce = self.extranonce
+			if getattr(j, 'extranonce', None) == extranonce:
+				return
+			j.coinbase_prefix = sha256(unhexlify(j.coinbase1 + extranonce))
+			j.coinbase_suffix = unhexlify(j.coinbase2)
+			j.merkle_branch_bytes = [unhexlify(hash_) for hash_ in j.merkle_branch]
+			j.header_prefix = j.version + j.prevhash
+			j.header_suffix = j.ntime + j.nbits
+			j.extranonce = extranonce
+
+	def block_header(self, j, extranonce2):
+		coinbase = j.coinbase_prefix.copy()
+		coinbase.update(unhexlify(extranonce2))
+		coinbase.update(j.coinbase_suffix)
+
+		merkle_root = sha256(coinbase.digest()).digest()
+		for hash_ in j.merkle_branch_bytes:
+			merkle_root = sha256(sha256(merkle_root + hash_).digest()).digest()
+		merkle_root = pack('>8I', *unpack('<8I', merkle_root))
+
+		return ''.join([j.header_prefix, hexlify(merkle_root), j.header_suffix])
+
+	def reserve(self, j):
+		# a contiguous extranonce2 range of j, wrapping around like the counter it replaces
+		space = 2 ** (8 * self.extranonce2_size)
+		size = max(min(RANGE_SIZE, space / max(len(self.switch.miners), 1)), 1)
+		if j.next_extranonce2 + size > space:
+			j.next_extranonce2 = 0
+		start = j.next_extranonce2
+		j.next_extranonce2 += size
+		return [j, start, start + size]
+
+	def next_extranonce2(self, miner, j):
+		# each miner takes extranonce2 values from its own range, so miners never share work
+		# and can build headers in any thread, only this counter is locked
+		with self.reserve_lock:
+			reservation = self.reservations.get(miner)
+			if not reservation or reservation[0] is not j or reservation[1] >= reservation[2]:
+				reservation = self.reservations[miner] = self.reserve(j)
+			extranonce2 = reservation[1]
+			reservation[1] += 1
+		return '%0*x' % (self.extranonce2_size * 2, extranonce2)
+
+	def refresh_jobs(self, miner, count):
+		# work for the next count extranonce2 values of miner's range of the current job
+		j = self.current_job
+		start = time()
+		if getattr(j, 'extranonce', None) != self.extranonce:
+			self.prepare_job(j)
+
+		works = []
+		for i in xrange(count):
+			work = Object()
+			work.job_id = j.job_id
+			work.extranonce2 = self.next_extranonce2(miner, j)
+			work.block_header = self.block_header(j, work.extranonce2)
+			works.append(work)
+
+		self.headers_generated += count
+		self.generation_time += time() - start
+		return works
 
 	def handle_message(self, message):
 
@@ -188,20 +366,20 @@ class StratumSource(Source):
 				clear_jobs = params[8]
 				if clear_jobs:
 					self.jobs.clear()
-				j.extranonce2 = self.extranonce2_size * '00'
-
-				j = self.refresh_job(j)
+					if self.options.verbose and self.generation_time:
+						say_line('generated %d headers, %d per second', (self.headers_generated, self.headers_generated / self.generation_time))
+				j.next_extranonce2 = 0
+				self.prepare_job(j)
 
 				self.jobs[j.job_id] = j
 				self.current_job = j
 
-				self.queue_work(j)
+				self.queue_work(self.refresh_jobs(self.switch.miners[0], 1)[0])
 				self.switch.connection_ok()
 
 			#mining.get_version
 			if message['method'] == 'mining.get_version':
-				with self.send_lock:
-					self.send_message({"error": None, "id": message['id'], "result": self.user_agent})
+				self.send_message({"error": None, "id": message['id'], "result": self.user_agent})
 
 			#mining.set_difficulty
 			elif message['method'] == 'mining.set_difficulty':
@@ -216,118 +394,85 @@ class StratumSource(Source):
 				if new_port != None: port = new_port
 				say_line("%s asked us to reconnect to %s:%d in %d seconds", (self.server().name, address, port, timeout))
 				self.server().host = address + ':' + str(port)
-				Timer(timeout, self.reconnect).start()
+				self.reconnect_time = time() + timeout
 
 			#client.add_peers
 			elif message['method'] == 'client.add_peers':
 				hosts = [{'host': host[0], 'port': host[1]} for host in message['params'][0]]
 				self.switch.add_servers(hosts)
 
-		#responses to server API requests
+		#responses to our requests, matched by id
+		#cleanup submits the server never answered if necessary
 		elif 'result' in message:
-
-			#response to mining.subscribe
-			#store extranonce and extranonce2_size
-			if message['id'] == 's':
-				self.extranonce = message['result'][1]
-				self.extranonce2_size = message['result'][2]
-				self.subscribed = True
-
-			#check if this is submit confirmation (message id should be in submits dictionary)
-			#cleanup if necessary
-			elif message['id'] in self.submits:
-				miner, nonce = self.submits[message['id']][:2]
-				accepted = message['result']
-				self.switch.report(miner, nonce, accepted)
-				del self.submits[message['id']]
-				if time() - self.last_submits_cleanup > 3600:
-					now = time()
-					for key, value in self.submits.items():
-						if now - value[2] > 3600:
-							del self.submits[key]
-					self.last_submits_cleanup = now
-
-			#response to mining.authorize
-			elif message['id'] == self.server().user:
-				if not message['result']:
-					say_line('authorization failed with %s:%s@%s', (self.server().user, self.server().pwd, self.server().host))
-					self.authorized = False
-				else:
-					self.authorized = True
+			future = self.futures.pop(message['id'], None)
+			if future:
+				future.set_result(message)
+			if time() - self.last_futures_cleanup > 3600:
+				now = time()
+				for key, future in self.futures.items():
+					if now - future.created > 3600:
+						del self.futures[key]
+				self.last_futures_cleanup = now
 
 	def reconnect(self):
 		say_line("%s reconnecting to %s", (self.server().name, self.server().host))
-		self.handler.close()
+		self.reconnect_time = None
+		self.connected_time = 0 # the server asked for this, no need to back off
+		self.close()
+
+	def subscribed(self, message):
+		if message['result']:
+			self.extranonce = message['result'][1]
+			self.extranonce2_size = message['result'][2]
 
 	def subscribe(self):
-		self.send_message({'id': 's', 'method': 'mining.subscribe', 'params': []})
-		for i in xrange(10):
-			sleep(1)
-			if self.subscribed: break
-		return self.subscribed
+		future = self.request('mining.subscribe', [], self.subscribed)
+		return self.wait(future, REQUEST_TIMEOUT) and bool(future.result['result'])
 
 	def authorize(self):
-		self.send_message({'id': self.server().user, 'method': 'mining.authorize', 'params': [self.server().user, self.server().pwd]})
-		for i in xrange(10):
-			sleep(1)
-			if self.authorized != None: break
-		return self.authorized
+		future = self.request('mining.authorize', [self.server().user, self.server().pwd])
+		if not self.wait(future, REQUEST_TIMEOUT):
+			return False
+		if not future.result['result']:
+			say_line('authorization failed with %s:%s@%s', (self.server().user, self.server().pwd, self.server().host))
+			return False
+		return True
 
 	def send_internal(self, result, nonce):
 		job_id = result.job_id
 		if not job_id in self.jobs:
+			result.miner.stale_shares += 1
 			return True
+		if not self.socket:
+			return False
 		extranonce2 = result.extranonce2
 		ntime = pack('I', long(result.time)).encode('hex')
 		hex_nonce = pack('I', long(nonce)).encode('hex')
-		id_ = job_id + hex_nonce
-		self.submits[id_] = (result.miner, nonce, time())
-		return self.send_message({'params': [self.server().user, job_id, extranonce2, ntime, hex_nonce], 'id': id_, 'method': u'mining.submit'})
+		self.request(u'mining.submit', [self.server().user, job_id, extranonce2, ntime, hex_nonce], lambda message: self.switch.report(result.miner, nonce, message['result']))
+		return True
 
-	def send_message(self, message):
-		data = dumps(message) + '\n'
-		try:
-			#self.handler.push(data)
+	def request(self, method, params, callback=None):
+		self.request_id += 1
+		future = Future(callback)
+		self.futures[self.request_id] = future
+		self.send_message({'params': params, 'id': self.request_id, 'method': method})
+		return future
 
-			#there is some bug with asyncore's send mechanism
-			#so we send data 'manually'
-			#note that this is not thread safe
-			if not self.handler:
-				return False
-			while data:
-				sent = self.handler.send(data)
-				data = data[sent:]
-			return True
-		except AttributeError:
-			self.stop()
-		except Exception:
-			say_exception()
-			self.stop()
+	def send_message(self, message):
+		# only the loop thread touches the socket, other threads queue and wake it up
+		self.write_queue.append(dumps(message) + '\n')
+		self.wakeup()
 
-	def queue_work(self, work, miner=None):
+	def queue_work(self, work, miner=None, prefetch=False):
 		target = ''.join(list(chunks('%064x' % self.server_difficulty, 2))[::-1])
-		self.switch.queue_work(self, work.block_header, target, work.job_id, work.extranonce2, miner)
-
-class Handler(asynchat.async_chat):
-	def __init__(self, socket, map_, parent):
-		asynchat.async_chat.__init__(self, socket, map_)
-		self.parent = parent
-		self.data = ''
-		self.set_terminator('\n')
-
-	def handle_close(self):
-		self.close()
-		self.parent.handler = None
-		self.parent.socket = None
-
-	def handle_error(self):
-		say_exception()
-		self.parent.stop()
+		self.switch.queue_work(self, work.block_header, target, work.job_id, work.extranonce2, miner, prefetch)
 
-	def collect_incoming_data(self, data):
-		self.data += data
+	def prefetch_work(self, miner):
+		if self.current_job:
+			self.queue_work(self.refresh_jobs(miner, 1)[0], miner, True)
+			return True
 
-	def found_terminator(self):
-		message = loads(self.data)
-		self.parent.handle_message(message)
-		self.data = ''
+	def local_work(self, miner):
+		if self.current_job and self.socket:
+			self.queue_work(self.refresh_jobs(miner, 1)[0], miner)
+			return True
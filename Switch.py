@@ -1,9 +1,12 @@
 
+from collections import OrderedDict
 from copy import copy
 from log import say_exception, say_line, say_quiet
-from sha256 import sha256, STATE, partial, calculateF, hash
+from metrics import Histogram, LATENCY_BUCKETS
+from Queue import Empty
+from sha256 import sha256, STATE, partial, calculateF, hash_nonces, hash_headers
 from struct import pack, unpack
-from threading import RLock
+from threading import RLock, Thread, Event
 from time import time, sleep
 from util import if_else, Object, chunks, bytereverse, belowOrEquals
 import GetworkSource
@@ -11,6 +14,7 @@ import StratumSource
 import log
 import numpy as np
 
+DECODE_CACHE_SIZE = 64
 
 class Switch(object):
 	def __init__(self, options):
@@ -35,6 +39,17 @@ class Switch(object):
 		self.last_block = ''
 
 		self.sent = {}
+		self.submit_latency = Histogram(LATENCY_BUCKETS)
+
+		self.prefetch_event = Event()
+
+		self.should_stop = False
+		self.stop_event = Event()
+		self.threads = []
+
+		self.decode_cache = OrderedDict()
+		self.decode_cache_block = None
+		self.decode_cache_hits = self.decode_cache_misses = 0
 
 		if self.options.proxy:
 			self.options.proxy = self.parse_server(self.options.proxy, False)
@@ -90,12 +105,20 @@ class Switch(object):
 
 	def loop(self):
 		self.should_stop = False
+		self.stop_event.clear()
 		if not self.servers:
 			print '\nAt least one server is required'
 			return
 		else:
 			self.set_server_index(0)
 
+		self.threads = [Thread(target=self.status_thread)]
+		if self.options.prefetch:
+			self.threads.append(Thread(target=self.prefetch_thread))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
 		while True:
 			if self.should_stop: return
 
@@ -138,6 +161,8 @@ class Switch(object):
 
 	def stop(self):
 		self.should_stop = True
+		self.stop_event.set()
+		self.prefetch_event.set()
 		if self.server_index != -1:
 			self.server_source().stop()
 
@@ -147,29 +172,60 @@ class Switch(object):
 			job = Object()
 	
 			binary_data = block_header.decode('hex')
-			data0 = np.zeros(64, np.uint32)
-			data0 = np.insert(data0, [0] * 16, unpack('IIIIIIIIIIIIIIII', binary_data[:64]))
 	
 			job.target	  = np.array(unpack('IIIIIIII', target.decode('hex')), dtype=np.uint32)
 			job.header	  = binary_data[:68]
 			job.merkle_end  = np.uint32(unpack('I', binary_data[64:68])[0])
 			job.time		= np.uint32(unpack('I', binary_data[68:72])[0])
 			job.difficulty  = np.uint32(unpack('I', binary_data[72:76])[0])
-			job.state	   = sha256(STATE, data0)
-			job.f		   = np.zeros(8, np.uint32)
-			job.state2	  = partial(job.state, job.merkle_end, job.time, job.difficulty, job.f)
+			job.state, job.state2, job.f = self.precalculate(binary_data, job.merkle_end, job.time, job.difficulty)
 			job.targetQ	 = 2**256 / int(''.join(list(chunks(target, 2))[::-1]), 16)
 			job.job_id	  = job_id
 			job.extranonce2 = extranonce2
 			job.server	  = server
-	
-			calculateF(job.state, job.merkle_end, job.time, job.difficulty, job.f, job.state2)
 
 			if job.difficulty != self.difficulty:
 				self.set_difficulty(job.difficulty)
 	
 			return job
 
+	def precalculate(self, binary_data, merkle_end, ntime, difficulty):
+		with self.lock:
+			if self.decode_cache_block != binary_data[4:36]:
+				self.decode_cache_block = binary_data[4:36]
+				self.clear_decode_cache()
+			cached = self.decode_cache.pop(binary_data[:64], None)
+			if cached:
+				self.decode_cache_hits += 1
+			else:
+				self.decode_cache_misses += 1
+
+		if cached:
+			state, tail, state2, f = cached
+		else:
+			data0 = np.zeros(64, np.uint32)
+			data0 = np.insert(data0, [0] * 16, unpack('IIIIIIIIIIIIIIII', binary_data[:64]))
+			state = sha256(STATE, data0)
+			tail = None
+
+		if tail != binary_data[64:76]:
+			tail = binary_data[64:76]
+			f = np.zeros(8, np.uint32)
+			state2 = partial(state, merkle_end, ntime, difficulty, f)
+			calculateF(state, merkle_end, ntime, difficulty, f, state2)
+
+		with self.lock:
+			self.decode_cache[binary_data[:64]] = (state, tail, state2, f)
+			while len(self.decode_cache) > DECODE_CACHE_SIZE:
+				self.decode_cache.popitem(False)
+
+		return np.copy(state), np.copy(state2), np.copy(f)
+
+	def clear_decode_cache(self):
+		if self.options.verbose and self.decode_cache:
+			say_line('decode cache: %d hits, %d misses', (self.decode_cache_hits, self.decode_cache_misses))
+		self.decode_cache.clear()
+
 	def set_difficulty(self, difficulty):
 		self.difficulty = difficulty
 		bits = '%08x' % difficulty.byteswap()
@@ -178,11 +234,19 @@ class Switch(object):
 		self.true_target = np.array(unpack('IIIIIIII', true_target.decode('hex')), dtype=np.uint32)
 
 	def send(self, result, send_callback):
-		for nonce in result.miner.nonce_generator(result.nonces):
-			h = hash(result.state, result.merkle_end, result.time, result.difficulty, nonce)
-			if h[7] != 0:
+		nonces = list(result.miner.nonce_generator(result.nonces))
+		if not nonces:
+			return True
+		valid, hashes = hash_headers(result.header, result.time, result.difficulty, nonces)
+		if self.options.cross_check:
+			midstate_hashes = hash_nonces(result.state, result.merkle_end, result.time, result.difficulty, nonces)[1]
+			if (midstate_hashes != hashes).any():
+				say_line('Verification mismatch between hashlib and midstate hashes (%s)', result.miner.id())
+		for nonce, ok, h in zip(nonces, valid, hashes):
+			if not ok:
 				hash6 = pack('I', long(h[6])).encode('hex')
 				say_line('Verification failed, check hardware! (%s, %s)', (result.miner.id(), hash6))
+				result.miner.hardware_errors += 1
 				return True # consume this particular result
 			else:
 				self.diff1_found(bytereverse(h[6]), result.target[6])
@@ -190,29 +254,60 @@ class Switch(object):
 					is_block = belowOrEquals(h[:7], self.true_target[:7])
 					hash6 = pack('I', long(h[6])).encode('hex')
 					hash5 = pack('I', long(h[5])).encode('hex')
-					self.sent[nonce] = (is_block, hash6, hash5)
+					self.sent[nonce] = (is_block, hash6, hash5, time())
 					if not send_callback(result, nonce):
 						return False
 		return True
 
 	def diff1_found(self, hash_, target):
 		if self.options.verbose and target < 0xFFFF0000L:
-			say_line('checking %s <= %s', (hash_, target))
-
-	def status_updated(self, miner):
-		verbose = self.options.verbose
-		rate = if_else(verbose, miner.rate, sum([m.rate for m in self.miners]))
-		estimated_rate = if_else(verbose, miner.estimated_rate, sum([m.estimated_rate for m in self.miners]))
-		rejected_shares = if_else(verbose, miner.share_count[0], sum([m.share_count[0] for m in self.miners]))
-		total_shares = rejected_shares + if_else(verbose, miner.share_count[1], sum([m.share_count[1] for m in self.miners]))
+			if log.json_events:
+				log.event('check', hash=int(hash_), target=int(target))
+			else:
+				say_line('checking %s <= %s', (hash_, target))
+
+	def status_thread(self):
+		# the only place status is printed, miners just update their counters
+		last_table = time()
+		while not self.stop_event.wait(max(self.options.rate, 0.1)):
+			if self.options.verbose:
+				for miner in self.miners:
+					self.status_updated([miner], miner.id() + ' ')
+				source = self.source()
+				if source:
+					source.status()
+			else:
+				self.status_updated(self.miners)
+			if self.options.status_table and time() - last_table >= self.options.status_table:
+				self.status_table()
+				last_table = time()
+
+	def status_updated(self, miners, prefix=''):
+		rate = sum([m.rate for m in miners])
+		estimated_rate = sum([m.estimated_rate for m in miners])
+		rejected_shares = sum([m.share_count[0] for m in miners])
+		total_shares = rejected_shares + sum([m.share_count[1] for m in miners])
 		total_shares_estimator = max(total_shares, 1)
-		say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (if_else(verbose, miner.id()+' ', '') , rate, round(estimated_rate), rejected_shares, total_shares, float(rejected_shares) * 100 / total_shares_estimator))
+		if log.json_events:
+			log.event('rate', devices=[m.id() for m in miners], rate=rate, estimated_rate=estimated_rate, accepted=total_shares - rejected_shares, rejected=rejected_shares, server=log.server)
+			return
+		say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (prefix, rate, round(estimated_rate), rejected_shares, total_shares, float(rejected_shares) * 100 / total_shares_estimator))
+
+	def status_table(self):
+		with log.lock:
+			say_line('%-10s %10s %8s %8s %8s %9s %9s', ('device', 'MH/s', '~1m', '~15m', '~1h', 'accepted', 'rejected'))
+			for miner in self.miners:
+				rates = miner.estimated_rates
+				say_line('%-10s %10.3f %8d %8d %8d %9d %9d', (miner.id(), miner.rate, round(rates.get(60, 0)), round(rates.get(900, 0)), round(rates.get(3600, 0)), miner.share_count[1], miner.share_count[0]))
 
 	def report(self, miner, nonce, accepted):
-		is_block, hash6, hash5 = self.sent[nonce]
+		is_block, hash6, hash5, sent_time = self.sent[nonce]
+		self.submit_latency.observe(time() - sent_time)
 		miner.share_count[if_else(accepted, 1, 0)] += 1
 		hash_ = if_else(is_block, hash6 + hash5, hash6)
-		if self.options.verbose or is_block:
+		if log.json_events:
+			log.event(if_else(is_block, 'block', 'share'), device=miner.id(), hash=hash_, accepted=accepted, latency=round(time() - sent_time, 4))
+		elif self.options.verbose or is_block:
 			say_line('%s %s%s, %s', (miner.id(), if_else(is_block, 'block ', ''), hash_, if_else(accepted, 'accepted', '_rejected_')))
 		del self.sent[nonce]
 
@@ -221,9 +316,12 @@ class Switch(object):
 		user = self.servers[server_index].user
 		name = self.servers[server_index].name
 		#say_line('Setting server %s (%s @ %s)', (name, user, host))
-		say_line('Setting server (%s @ %s)', (user, name))
 		log.server = name
-		
+		if log.json_events:
+			log.event('server', user=user, server=name)
+		else:
+			say_line('Setting server (%s @ %s)', (user, name))
+		self.clear_ready_queues()
 
 	def add_servers(self, hosts):
 		for host in hosts[::-1]:
@@ -241,23 +339,54 @@ class Switch(object):
 				return True
 		return False
 
-	def queue_work(self, server, block_header, target = None, job_id = None, extranonce2 = None, miner=None):
+	def queue_work(self, server, block_header, target = None, job_id = None, extranonce2 = None, miner=None, prefetch=False):
 		work = self.decode(server, block_header, target, job_id, extranonce2)
 		with self.lock:
+			if prefetch:
+				if work and work.header[25:29] == self.last_block and server is self.source():
+					work.ready_time = time()
+					miner.ready_queue.put(work)
+				return
 			if not miner:
 				miner = self.miners[0]
 				for i in xrange(1, len(self.miners)):
 					self.miners[i].update = True
 			miner.work_queue.put(work)
 			if work:
-				miner.update = False; self.last_work = time()
+				miner.update = False; self.last_work = miner.work_time = time()
 				if self.last_block != work.header[25:29]:
 					self.last_block = work.header[25:29]
 					self.clear_result_queue(server)
+					self.clear_ready_queues()
+
+	def clear_ready_queues(self):
+		for miner in self.miners:
+			while not miner.ready_queue.empty():
+				miner.ready_queue.get(False)
+
+	def prefetch_thread(self):
+		while not self.should_stop:
+			self.prefetch_event.wait(1)
+			self.prefetch_event.clear()
+			try:
+				for miner in self.miners:
+					while miner.ready_queue.qsize() < self.options.prefetch and not self.should_stop:
+						source = self.source()
+						if not source or getattr(source, 'should_stop', True) or not source.prefetch_work(miner):
+							break
+			except Exception:
+				say_exception('Prefetch error:')
 
 	def clear_result_queue(self, server):
 		while not server.result_queue.empty():
-			server.result_queue.get(False)
+			server.result_queue.get(False).miner.stale_shares += 1
+		if hasattr(server, 'submit_queue'):
+			# submit threads take from this queue too
+			try:
+				while True:
+					server.submit_queue.get(False)[0].miner.stale_shares += 1
+			except Empty:
+				pass
 
 	def server_source(self):
 		if not hasattr(self.server(), 'source'):
@@ -297,3 +426,17 @@ class Switch(object):
 
 	def put(self, result):
 		result.server.result_queue.put(result)
+		result.server.wakeup()
+
+	def source(self):
+		if self.server_index != -1:
+			return getattr(self.server(), 'source', None)
+
+	def wakeup_source(self):
+		source = self.source()
+		if source:
+			source.wakeup()
+
+	def local_work(self, miner):
+		source = self.source()
+		return source and not getattr(source, 'should_stop', True) and source.local_work(miner)
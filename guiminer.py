@@ -478,8 +478,49 @@ def nonBlockRead(output):
     except:
         return ''
                 
+
+class LineClassifier(object):
+    """Classify lines against a list of (pattern, event_func), compiled once.
+
+    By default patterns are tried in order and the first one found anywhere
+    in the line wins. With combine=True they are joined into one alternation
+    with a named group per pattern, so each line is scanned once and the
+    leftmost match wins, ties going to the earlier pattern. That is faster
+    when most lines match a later pattern, as with cgminer and phoenix, and
+    slower when the first pattern matches most lines, as with cudaminer and
+    the proxy: sre can skip ahead on a single pattern's first character but
+    not on an alternation's. It only differs from the cascade on lines that
+    several patterns match; mockMinerLogs.py --bench compares the two.
+    """
+    def __init__(self, lines, combine=False):
+        self.patterns = [(re.compile(pattern, re.I), event_func)
+                         for pattern, event_func in lines]
+        self.searches = [(regex.search, event_func)
+                         for regex, event_func in self.patterns]
+        self.combined = None
+        if combine and len(lines) > 1:
+            self.combined = re.compile('|'.join(
+                '(?P<p%d>%s)' % (i, pattern)
+                for i, (pattern, event_func) in enumerate(lines)), re.I).search
+
+    def search(self, line):
+        """Return (event_func, match) for the winning pattern, or (None, None)."""
+        if self.combined is not None:
+            match = self.combined(line)
+            if match is None:
+                return None, None
+            # rematch the winning pattern alone so its groups are numbered as in LINES
+            regex, event_func = self.patterns[int(match.lastgroup[1:])]
+            return event_func, regex.match(line, match.start(match.lastgroup))
+        for search, event_func in self.searches:
+            match = search(line)
+            if match is not None:
+                return event_func, match
+        return None, None
+
+
 class MinerListenerThread(threading.Thread):
-    LINES = ["""
+    LINES = [
         (r"Target =|average rate|Sending to server|found hash|connected to|Setting server",
             lambda _: None), # Just ignore lines like these
         (r"accepted|\"result\":\s*true",
@@ -495,8 +536,20 @@ class MinerListenerThread(threading.Thread):
         (r"(\d+)\s*Mhash/s", lambda match:
             UpdateHashRateEvent(rate=int(match.group(1)) * 1000)),
         (r"checking (\d+)", lambda _:
-            UpdateSoloCheckEvent()),"""
+            UpdateSoloCheckEvent()),
     ] 
+    COMBINE_LINES = False # see LineClassifier, set where mockMinerLogs.py --bench shows it wins
+
+    # Events printed by poclbm --json-events, keyed by their "event" field
+    JSON_EVENTS = {
+        'rate': lambda event: UpdateHashRateEvent(rate=event['rate'] * 1000),
+        'share': lambda event: UpdateAcceptedEvent(accepted=event['accepted']),
+        'block': lambda event: UpdateAcceptedEvent(accepted=event['accepted']),
+        'check': lambda event: UpdateSoloCheckEvent(),
+        'server': lambda event: None,
+        'error': lambda event: UpdateStatusEvent(text='%s %s' % (event['message'], event['error'])),
+        'message': lambda event: UpdateStatusEvent(text=event['text']),
+    }
 
     def __init__(self, parent, miner):
         threading.Thread.__init__(self)
@@ -504,6 +557,34 @@ class MinerListenerThread(threading.Thread):
         self.parent = parent
         self.parent_name = parent.name
         self.miner = miner
+
+    @classmethod
+    def get_classifier(cls):
+        """Return the LineClassifier for cls.LINES, compiling it on first use."""
+        if 'classifier' not in cls.__dict__:
+            cls.classifier = LineClassifier(cls.LINES, cls.COMBINE_LINES)
+        return cls.classifier
+
+    @classmethod
+    def parse_line(cls, line):
+        """Return (recognized, event) for a line of miner output.
+
+        Lines from poclbm --json-events are decoded and dispatched on their
+        event kind, anything else goes through the LINES patterns.
+        """
+        if line[0] == '{':
+            try:
+                message = json.loads(line)
+                event_func = cls.JSON_EVENTS.get(message.get('event'))
+            except (ValueError, AttributeError):
+                event_func = None
+            if event_func is not None:
+                return True, event_func(message)
+
+        event_func, match = cls.get_classifier().search(line)
+        if event_func is not None:
+            return True, event_func(match)
+        return False, None
         
     def run(self):
         logger.info(_('Listener for "%s" started') % self.parent_name)
@@ -511,16 +592,11 @@ class MinerListenerThread(threading.Thread):
             line = self.miner.stdout.readline().strip()
             # logger.debug("Line: %s", line)
             if not line: continue
-           
-            for s, event_func in self.LINES: # Use self to allow subclassing
-                match = re.search(s, line, flags=re.I)
-                if match is not None:
-                    event = event_func(match)
-                    if event is not None:
-                        wx.PostEvent(self.parent, event)
-                    break     
-           
-            else:
+
+            recognized, event = self.parse_line(line) # Use self to allow subclassing
+            if event is not None:
+                wx.PostEvent(self.parent, event)
+            elif not recognized:
                 # Possible error or new message, just pipe it through
                 event = UpdateStatusEvent(text=line)
                 logger.info(_('Listener for "%(name)s": %(line)s'),
@@ -542,6 +618,7 @@ class PhoenixListenerThread(MinerListenerThread):
         (r"Currently on block",
             lambda _: None), # Just ignore lines like these
     ]
+    COMBINE_LINES = True
     
 class CgListenerThread(MinerListenerThread):
     LINES = [
@@ -566,6 +643,7 @@ class CgListenerThread(MinerListenerThread):
         (r"^GPU\s*\d+",
             lambda _: None), # Just ignore lines like these
     ]
+    COMBINE_LINES = True
 
 # Below is kind of an ugly hack for updating reaper shares, but it works - TacoTime
 class ReaperListenerThread(MinerListenerThread):
@@ -588,11 +666,11 @@ class CudaminerListenerThread(MinerListenerThread):
      
 class ProxyListenerThread(MinerListenerThread):
     LINES = [
-        (r".* accepted, .*",
+        (r" accepted, ",
             lambda _: UpdateAcceptedEvent(accepted=True)),
-        (r".* REJECTED:.*",
+        (r" REJECTED:",
             lambda _: UpdateAcceptedEvent(accepted=False)),
-        (r".*LISTENING.*", lambda match:
+        (r"LISTENING", lambda match:
             UpdateHashRateEvent(rate = -0.0000001)),
     ]
 
@@ -1045,7 +1123,7 @@ class MinerTab(wx.Panel):
                 executable = "poclbm.exe"
             else:
                 executable = "python poclbm.py"
-        cmd = "%s %s:%s@%s:%s --device=%d --platform=%d --verbose -r1 %s" % (
+        cmd = "%s %s:%s@%s:%s --device=%d --platform=%d --verbose -r1 %s%s" % (
                 executable,
                 self.txt_username.GetValue(),
                 self.txt_pass.GetValue(),
@@ -1053,6 +1131,7 @@ class MinerTab(wx.Panel):
                 self.txt_port.GetValue(),
                 self.device_index,
                 self.platform_index,
+                '' if USE_MOCK else '--json-events ',
                 self.txt_flags.GetValue()
         )
         return cmd, folder
@@ -1,33 +1,54 @@
 from datetime import datetime
+from json import dumps
 from threading import RLock
+from time import time
 import sys
 import traceback
 
 quiet = False
 verbose = False
+json_events = False
 server = ''
 lock = RLock()
 
 TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
 
+def json_default(value):
+	# numpy scalars and anything else with a plain Python counterpart
+	if hasattr(value, 'item'):
+		return value.item()
+	raise TypeError('%r is not JSON serializable' % (value,))
+
+def event(kind, **fields):
+	fields['event'] = kind
+	fields['time'] = round(time(), 3)
+	with lock:
+		sys.stdout.write(dumps(fields, separators=(',', ':'), default=json_default) + '\n')
+		sys.stdout.flush()
+
 def say(format_, args=(), say_quiet=False):
 	if quiet and not say_quiet: return
 	with lock:
 		p = format_ % args
-		if verbose:
+		if json_events:
+			event('message', text=p.strip(), server=server)
+		elif verbose:
 			print '%s %s,' % (server, datetime.now().strftime(TIME_FORMAT)), p
 		else:
 			sys.stdout.write('\r%s\r%s %s' % (' '*80, server, p))
 		sys.stdout.flush()
 
 def say_line(format_, args=()):
-	if not verbose:
+	if not verbose and not json_events:
 		format_ = '%s, %s\n' % (datetime.now().strftime(TIME_FORMAT), format_)
 	say(format_, args)
 
 def say_exception(message=''):
 	type_, value, tb = sys.exc_info()
-	say_line(message + ' %s', str(value))
+	if json_events:
+		event('error', message=message.strip(), error=str(value), server=server)
+	else:
+		say_line(message + ' %s', str(value))
 	if verbose:
 		traceback.print_exception(type_, value, tb)
 
@@ -0,0 +1,90 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+from threading import Thread
+from time import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kwargs):
+	return '{%s}' % ','.join(['%s="%s"' % (key, escape(kwargs[key])) for key in sorted(kwargs)])
+
+def render(switch):
+	lines = []
+	def metric(name, kind, description, samples):
+		lines.append('# HELP %s %s' % (name, description))
+		lines.append('# TYPE %s %s' % (name, kind))
+		for suffix, label, value in samples:
+			lines.append('%s%s%s %s' % (name, suffix, label, repr(float(value))))
+
+	now = time()
+	miners = list(switch.miners)
+	metric('poclbm_hashrate_mhs', 'gauge', 'Current hash rate in MH/s.',
+		[('', labels(device=m.id()), m.rate) for m in miners])
+	metric('poclbm_estimated_rate_mhs', 'gauge', 'Hash rate estimated from accepted shares in MH/s.',
+		[('', labels(device=m.id(), window=length), rate) for m in miners for length, rate in sorted(m.estimated_rates.items())])
+	metric('poclbm_shares_total', 'counter', 'Shares by result.',
+		[('', labels(device=m.id(), result=result), count) for m in miners for result, count in (('accepted', m.share_count[1]), ('rejected', m.share_count[0]), ('stale', m.stale_shares))])
+	metric('poclbm_hardware_errors_total', 'counter', 'Results that failed verification.',
+		[('', labels(device=m.id()), m.hardware_errors) for m in miners])
+	metric('poclbm_temperature_celsius', 'gauge', 'Device temperature.',
+		[('', labels(device=m.id()), m.temperature) for m in miners if m.temperature is not None])
+	metric('poclbm_queue_depth', 'gauge', 'Jobs waiting in miner queues.',
+		[('', labels(device=m.id(), queue=name), queue.qsize()) for m in miners for name, queue in (('work', m.work_queue), ('ready', m.ready_queue))])
+	metric('poclbm_job_age_seconds', 'gauge', 'Time since the device was last given work.',
+		[('', labels(device=m.id()), now - m.work_time) for m in miners if m.work_time])
+
+	source = switch.source()
+	if source:
+		queues = [('result', source.result_queue)]
+		if hasattr(source, 'submit_queue'):
+			queues.append(('submit', source.submit_queue))
+		metric('poclbm_source_queue_depth', 'gauge', 'Results waiting to be verified or submitted.',
+			[('', labels(queue=name), queue.qsize()) for name, queue in queues])
+
+	histogram = switch.submit_latency
+	samples = []
+	cumulative = 0
+	for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+		cumulative += count
+		samples.append(('_bucket', labels(le=bound), cumulative))
+	samples.append(('_sum', '', histogram.sum))
+	samples.append(('_count', '', histogram.count))
+	metric('poclbm_submit_latency_seconds', 'histogram', 'Time from sending a share to the server answering.', samples)
+
+	return '\n'.join(lines) + '\n'
+
+class Handler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		body = render(self.server.switch)
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+def serve(switch, port):
+	server = HTTPServer(('127.0.0.1', port), Handler)
+	server.switch = switch
+	thread = Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
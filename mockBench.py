@@ -0,0 +1,47 @@
+# Helpers shared by the --bench modes of mockBitForce.py, mockGetworkServer.py
+# and mockStratumPool.py.
+
+from util import Object
+
+
+def percentile(values, p):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+def bench_options(servers=[], **overrides):
+	# the poclbm.py options Switch, the sources and the miners read, with their defaults
+	options = Object()
+	options.servers = servers
+	options.proxy = ''
+	options.version = 'bench'
+	options.verbose = options.quiet = options.json_events = False
+	options.nsf = options.cross_check = options.stratum_proxies = False
+	options.bfl_shared_io = False
+	options.max_update_time = 60
+	options.estimate = 900
+	options.rate = 3600 # keep status lines out of the report
+	options.status_table = 0
+	options.prefetch = 0
+	options.metrics_port = 0
+	options.failback = 60
+	options.tolerance = 2
+	options.cutoff_temp = [95]
+	options.cutoff_interval = [0.01]
+	for name, value in overrides.items():
+		setattr(options, name, value)
+	return options
+
+def skip_verification(switch, report):
+	# the mock servers answer every submit whether the share is valid or not
+	switch.send = lambda result, send_callback: send_callback(result, result.nonce)
+	switch.report = report
+
+def stop_server(server, server_thread):
+	# stop every thread before returning, daemon threads still running at exit print tracebacks
+	server.shutdown()
+	server.server_close()
+	server_thread.join(5)
+	for thread in list(server.handlers):
+		thread.join(5)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# BitFORCE SHA256 emulator on a pseudo terminal, e.g.
+#   python mockBitForce.py
+# prints the port to give BFLMiner, or measure BFLMiner idle time with
+#   python mockBitForce.py --bench 60 [--devices 8 --shared-io]
+# Reported nonces are random and will fail verification in Switch.send.
+
+from optparse import OptionParser
+from random import gauss, random
+from struct import pack
+from threading import Thread
+from time import sleep, time
+from mockBench import bench_options, percentile
+from util import if_else
+import os
+import pty
+import select
+import tty
+
+DATA_SIZE = 8 + 44 + 8
+
+
+class BitForce(object):
+	def __init__(self, options):
+		self.options = options
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+
+		self.job_end = None
+		self.job_finished = None
+		self.result = None
+		self.temperature = 45.0
+		self.started = time()
+
+		self.jobs = self.polls = self.busy_polls = self.busy_submits = 0
+		self.busy_time = 0
+		self.idle_times = []
+
+	def start(self):
+		thread = Thread(target=self.serve)
+		thread.daemon = True
+		thread.start()
+
+	def busy(self):
+		if self.job_end and time() >= self.job_end:
+			self.job_finished = self.job_end
+			self.job_end = None
+			nonces = ['%08x' % int(random() * 0xFFFFFFFF) for i in xrange(int(random() * 2.5))]
+			self.result = if_else(nonces, 'NONCE-FOUND:' + ','.join(nonces), 'NO-NONCE')
+		return self.job_end != None
+
+	def start_job(self):
+		now = time()
+		if self.job_finished:
+			self.idle_times.append(now - self.job_finished)
+		duration = max(gauss(self.options.job_time, self.options.job_time * 0.01), 0)
+		self.job_end = now + duration
+		self.busy_time += duration
+		self.jobs += 1
+		self.result = None
+
+	def command(self, command):
+		if command == 'ZGX':
+			return '>>>ID: BitFORCE SHA256 Version 1.0>>>'
+		if command == 'ZLX':
+			self.temperature = min(max(self.temperature + gauss(0, 0.2), 40), 80)
+			return 'Temperature (celcius): %.2f' % self.temperature
+		if command == 'ZDX':
+			if self.busy():
+				self.busy_submits += 1
+				return 'BUSY'
+			return 'OK'
+		if command == 'ZFX':
+			self.polls += 1
+			if self.busy():
+				self.busy_polls += 1
+				return 'BUSY'
+			return self.result or 'NO-NONCE'
+		return 'ERR:UNKNOWN COMMAND'
+
+	def serve(self):
+		data = ''
+		expect_job = False
+		while True:
+			select.select([self.master], [], [])
+			data += os.read(self.master, 1024)
+			while True:
+				if expect_job:
+					if len(data) < DATA_SIZE: break
+					job, data = data[:DATA_SIZE], data[DATA_SIZE:]
+					expect_job = False
+					if job[:8] == '>>>>>>>>' and job[-8:] == '>>>>>>>>':
+						self.start_job()
+						response = 'OK'
+					else:
+						response = 'ERR:DATA'
+				else:
+					if len(data) < 3: break
+					command, data = data[:3], data[3:]
+					response = self.command(command)
+					expect_job = command == 'ZDX' and response == 'OK'
+				sleep(self.options.latency)
+				os.write(self.master, response + '\n')
+
+	def report(self):
+		elapsed = time() - self.started
+		print '%d jobs in %.1fs, device busy %.1f%%, %d ZFX polls (%d busy), %d ZDX while busy' % (self.jobs, elapsed, min(self.busy_time / elapsed, 1) * 100, self.polls, self.busy_polls, self.busy_submits)
+		print '  idle between jobs: mean %.1f ms, p50 %.1f ms, p90 %.1f ms, max %.1f ms' % (sum(self.idle_times) / max(len(self.idle_times), 1) * 1000, percentile(self.idle_times, 0.5) * 1000, percentile(self.idle_times, 0.9) * 1000, max(self.idle_times or [0]) * 1000)
+
+def bench(devices, seconds, shared_io):
+	from BFLMiner import BFLMiner, IOLoop
+	from Source import Source
+	from Switch import Switch
+	import log
+
+	options = bench_options(bfl_shared_io=shared_io)
+	log.quiet = True
+
+	switch = Switch(options)
+	io_loop = IOLoop()
+	for i in xrange(len(devices)):
+		miner = BFLMiner(i, devices[i].port, options)
+		miner.cutoff_temp = 95
+		miner.cutoff_interval = 0.01
+		if shared_io:
+			miner.io_loop = io_loop
+		switch.add_miner(miner)
+
+	server = Source(switch)
+	header = pack('>19I', *range(19)).encode('hex') + '1a0abbcf' + '00000000'
+	target = '0000000000000000000000000000000000000000000000000000ffff00000000'
+
+	for miner in switch.miners:
+		miner.start()
+	end = time() + seconds
+	while time() < end:
+		for miner in switch.miners:
+			if miner.update:
+				switch.queue_work(server, header, target, miner=miner)
+		sleep(0.01)
+	for miner in switch.miners:
+		miner.stop()
+
+if __name__ == '__main__':
+	parser = OptionParser()
+	parser.add_option('--job-time', dest='job_time', default=4294967296 / 832e6, help='seconds per 2^32 nonce job, default 5.16 (832 MH/s)', type='float')
+	parser.add_option('--latency',  dest='latency',  default=0.002, help='seconds before each response, default 0.002', type='float')
+	parser.add_option('--bench',    dest='bench',    default=0,     help='run BFLMiner against the emulator for N seconds and report', type='float')
+	parser.add_option('--devices',  dest='devices',  default=1,     help='number of emulated devices, default 1', type='int')
+	parser.add_option('--shared-io',dest='shared_io',action='store_true', help='bench BFLMiner with --bfl-shared-io')
+	(options, args) = parser.parse_args()
+
+	devices = [BitForce(options) for i in xrange(options.devices)]
+	for device in devices:
+		device.start()
+
+	if options.bench:
+		bench(devices, options.bench, options.shared_io)
+		for device in devices:
+			device.report()
+	else:
+		for device in devices:
+			print 'BitFORCE emulator on %s' % device.port
+		try:
+			while True:
+				sleep(60)
+				for device in devices:
+					device.report()
+		except KeyboardInterrupt:
+			for device in devices:
+				device.report()
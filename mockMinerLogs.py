@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Synthetic output of the miners guiminer drives, e.g.
+#   python mockMinerLogs.py --write logs
+# writes one log per listener, and
+#   python mockMinerLogs.py --bench [cgminer=captured.log ...]
+# replays synthetic or captured logs through each guiminer listener, timing
+# parse_line as the GUI runs it, and for text output also the old per
+# pattern re.search cascade against the compiled LineClassifier, in both its
+# cascade and combined alternation modes (COMBINE_LINES picks one per listener).
+# poclbm-json is what guiminer reads from poclbm --json-events.
+# --bench imports guiminer, so it needs everything the GUI needs.
+
+from datetime import datetime
+from json import dumps
+from optparse import OptionParser
+from random import choice, randint, random
+from time import time
+import os
+import re
+
+TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+
+def stamp():
+	return datetime.now().strftime(TIME_FORMAT)
+
+def nonce():
+	return '%08x' % randint(0, 0xFFFFFFFF)
+
+def rate(low, high):
+	return low + random() * (high - low)
+
+def event(kind, **fields):
+	# as printed by log.event
+	fields['event'] = kind
+	fields['time'] = round(time(), 3)
+	return dumps(fields, separators=(',', ':'))
+
+# listener class name and weighted line makers for each miner
+LOGS = {
+	'poclbm': ('MinerListenerThread', [
+		(20, lambda: 'pool:3333 %s, [%.3f MH/s (~%d MH/s)] [Rej: %d/%d (0.83%%)]' % (stamp(), rate(280, 320), randint(280, 320), randint(0, 3), randint(100, 200))),
+		(3, lambda: 'pool:3333 %s, GPU0 %s accepted' % (stamp(), nonce())),
+		(1, lambda: 'pool:3333 %s, GPU0 %s _rejected_' % (stamp(), nonce())),
+		(1, lambda: 'pool:3333 %s, checking %d <= %d' % (stamp(), randint(0, 0xFFFFFFFF), randint(0, 0xFFFFFFFF))),
+		(1, lambda: 'pool:3333 %s, long poll: new block %s%s' % (stamp(), nonce(), nonce())),
+		(1, lambda: 'pool:3333 %s, Setting server (user @ pool:3333)' % stamp()),
+	]),
+	'poclbm-json': ('MinerListenerThread', [
+		(20, lambda: event('rate', devices=['GPU0'], rate=rate(280, 320), estimated_rate=rate(280, 320), accepted=randint(100, 200), rejected=randint(0, 3), server='pool:3333')),
+		(3, lambda: event('share', device='GPU0', hash=nonce(), accepted=True, latency=rate(0.01, 0.1))),
+		(1, lambda: event('share', device='GPU0', hash=nonce(), accepted=False, latency=rate(0.01, 0.1))),
+		(1, lambda: event('check', hash=randint(0, 0xFFFFFFFF), target=randint(0, 0xFFFFFFFF))),
+		(1, lambda: event('message', text='long poll: new block %s%s' % (nonce(), nonce()), server='pool:3333')),
+		(1, lambda: event('server', user='user', server='pool:3333')),
+	]),
+	'phoenix': ('PhoenixListenerThread', [
+		(20, lambda: '[%.2f Mhash/sec] [%d Accepted] [%d Rejected] [RPC (+LP)]' % (rate(280, 320), randint(100, 200), randint(0, 3))),
+		(3, lambda: '[%s] Result: %s accepted' % (stamp(), nonce())),
+		(1, lambda: '[%s] Result: %s rejected' % (stamp(), nonce())),
+		(1, lambda: '[%s] Currently on block: %d' % (stamp(), randint(200000, 300000))),
+		(1, lambda: '[%s] Server gave new work; passing to WorkQueue' % stamp()),
+	]),
+	'cgminer': ('CgListenerThread', [
+		(20, lambda: ' (5s):%.1fK (avg):%.1fKh/s | A:%d R:%d HW:0 WU:%.1f/m' % (rate(580, 620), rate(580, 620), randint(100, 200), randint(0, 3), rate(500, 560))),
+		(10, lambda: 'GPU %d:  73.0C 2950RPM | %.1fK/%.1fKh/s | A:%d R:%d HW:0 WU:%.1f/m I:20' % (randint(0, 3), rate(580, 620), rate(580, 620), randint(100, 200), randint(0, 3), rate(500, 560))),
+		(3, lambda: ' [%s] Accepted %s Diff 1/1 GPU %d pool 0' % (stamp(), nonce(), randint(0, 3))),
+		(1, lambda: ' [%s] Rejected %s Diff 1/1 GPU %d pool 0' % (stamp(), nonce(), randint(0, 3))),
+		(1, lambda: ' [%s] Stratum from pool 0 detected new block' % stamp()),
+	]),
+	'reaper': ('ReaperListenerThread', [
+		(20, lambda: 'GPU %d | %d kH/s | shares: %d | stale: %d | %.1fC' % (randint(0, 3), randint(580, 620), randint(100, 200), randint(0, 3), rate(65, 80))),
+		(1, lambda: 'Pool: new block %s' % nonce()),
+	]),
+	'cudaminer': ('CudaminerListenerThread', [
+		(20, lambda: '[%s] GPU #0: GeForce GTX 660, %d hashes, %.2f khash/s' % (stamp(), randint(100000, 900000), rate(280, 320))),
+		(3, lambda: '[%s] accepted: %d/%d (99.17%%), %.2f khash/s (yay!!!)' % (stamp(), randint(100, 200), randint(200, 210), rate(280, 320))),
+		(1, lambda: '[%s] accepted: %d/%d (98.00%%), %.2f khash/s (booooo)' % (stamp(), randint(100, 200), randint(200, 210), rate(280, 320))),
+		(1, lambda: '[%s] Stratum detected new block' % stamp()),
+	]),
+	'proxy': ('ProxyListenerThread', [
+		(20, lambda: '%s,%03d INFO proxy jobs.submit # [%s] %s accepted, 1 difficulty' % (stamp(), randint(0, 999), nonce(), nonce())),
+		(2, lambda: '%s,%03d WARNING proxy jobs.submit # [%s] REJECTED: Job not found' % (stamp(), randint(0, 999), nonce())),
+		(1, lambda: '%s,%03d WARNING proxy LISTENING for workers on 0.0.0.0:8332' % (stamp(), randint(0, 999))),
+		(5, lambda: '%s,%03d INFO stratum.protocol New job %s for prevhash %s' % (stamp(), randint(0, 999), nonce(), nonce())),
+	]),
+}
+
+
+def generate(name, count):
+	makers = []
+	for weight, maker in LOGS[name][1]:
+		makers += [maker] * weight
+	return [choice(makers)() for i in xrange(count)]
+
+def cascade(lines, line):
+	for s, event_func in lines:
+		match = re.search(s, line, flags=re.I)
+		if match is not None:
+			return event_func, match
+	return None, None
+
+def groups(lines, event_func, match):
+	if event_func is None:
+		return None
+	pattern = [s for s, func in lines if func is event_func][0]
+	return [match.group(i) for i in xrange(re.compile(pattern).groups + 1)]
+
+def bench(logs):
+	import guiminer
+
+	for name in sorted(logs):
+		listener = getattr(guiminer, LOGS[name][0])
+		lines = [line.strip() for line in logs[name] if line.strip()]
+		start = time()
+		classifier = listener.get_classifier()
+		compiled = time() - start
+
+		# the whole path the GUI takes for a line, JSON events included
+		start = time()
+		unrecognized = 0
+		for line in lines:
+			if not listener.parse_line(line)[0]:
+				unrecognized += 1
+		parsed = time() - start
+		print '%-12s %-24s %7d lines: parse_line %8.0f lines/s, %d unrecognized' % (name, listener.__name__, len(lines), len(lines) / parsed, unrecognized)
+		if name.endswith('-json'):
+			continue
+
+		start = time()
+		for line in lines:
+			cascade(listener.LINES, line)
+		old = time() - start
+
+		start = time()
+		for line in lines:
+			classifier.search(line)
+		new = time() - start
+
+		modes = {}
+		for combine in (False, True):
+			other = guiminer.LineClassifier(listener.LINES, combine)
+			start = time()
+			for line in lines:
+				other.search(line)
+			modes[combine] = len(lines) / (time() - start)
+
+		mismatches = 0
+		for line in lines:
+			event_func, match = cascade(listener.LINES, line)
+			new_func, new_match = classifier.search(line)
+			if event_func is not new_func or groups(listener.LINES, event_func, match) != groups(listener.LINES, new_func, new_match):
+				mismatches += 1
+		print '%-12s %-24s %7s        cascade %8.0f lines/s, classifier %8.0f lines/s (%.1fx), compiled in %.2f ms, %d mismatches' % ('', '', '', len(lines) / old, len(lines) / new, old / new, compiled * 1000, mismatches)
+		print '%-12s %-24s %7s        compiled cascade %8.0f lines/s, alternation %8.0f lines/s, COMBINE_LINES = %s' % ('', '', '', modes[False], modes[True], listener.COMBINE_LINES)
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='usage: %prog [OPTION]... [MINER=LOGFILE]...')
+	parser.add_option('--lines', dest='lines', default=100000, help='lines of synthetic output per miner, default 100000', type='int')
+	parser.add_option('--write', dest='write', default='',     help='write synthetic logs to DIR/MINER.log and exit')
+	parser.add_option('--bench', dest='bench', action='store_true', help='replay logs through the guiminer listeners and report')
+	(options, args) = parser.parse_args()
+
+	logs = {}
+	for arg in args:
+		name, path = arg.split('=', 1)
+		if name not in LOGS:
+			parser.error('unknown miner %s, expected one of %s' % (name, ', '.join(sorted(LOGS))))
+		with open(path) as f:
+			logs[name] = f.readlines()
+	if not logs:
+		logs = dict([(miner, generate(miner, options.lines)) for miner in LOGS])
+
+	if options.write:
+		if not os.path.isdir(options.write):
+			os.makedirs(options.write)
+		for name in logs:
+			with open(os.path.join(options.write, name + '.log'), 'w') as f:
+				f.write('\n'.join(logs[name]) + '\n')
+	elif options.bench:
+		bench(logs)
+	else:
+		parser.print_help()
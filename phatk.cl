@@ -64,16 +64,20 @@ __constant ulong L = 0x198c7e2a2;
 // SHA round without W calc
 #define sharound(n) { Vals[(131 - n) % 8] += t1(n); Vals[(135 - n) % 8] = t1(n) + s0(n) + ma(n); }
 
-__kernel void search(	const uint state0, const uint state1, const uint state2, const uint state3,
-						const uint state4, const uint state5, const uint state6, const uint state7,
-						const uint B1, const uint C1, const uint D1,
-						const uint F1, const uint G1, const uint H1,
+// job holds the per-job constants written by the host in one transfer:
+// state0-7, B1, C1, D1, F1, G1, H1, W2, W16, W17, PreVal4, T1
+__kernel void search(	__constant uint * job,
 						const uint base,
-						const uint W2,
-						const uint W16, const uint W17,
-						const uint PreVal4, const uint T1,
 						__global uint * output)
 {
+	const uint state0 = job[0], state1 = job[1], state2 = job[2], state3 = job[3];
+	const uint state4 = job[4], state5 = job[5], state6 = job[6], state7 = job[7];
+	const uint B1 = job[8], C1 = job[9], D1 = job[10];
+	const uint F1 = job[11], G1 = job[12], H1 = job[13];
+	const uint W2 = job[14];
+	const uint W16 = job[15], W17 = job[16];
+	const uint PreVal4 = job[17], T1 = job[18];
+
 	u W[124];
 	u Vals[8];
 
@@ -1,4 +1,6 @@
+from struct import pack, unpack
 from util import uint32
+import hashlib
 import numpy as np
 
 K = np.array(	[0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
@@ -87,3 +89,70 @@ def hash(midstate, merkle_end, time, difficulty, nonce):
 	work[8]=0x80000000; work[15]=0x00000100
 
 	return sha256(STATE, work)
+
+def sha256_vector(state, data, partial_state=None, first_round=0, first_schedule=16):
+	initial = np.empty((8, data.shape[1]), np.uint32)
+	initial[:] = np.reshape(state, (8, -1))
+	digest = np.copy(initial)
+	if partial_state is not None:
+		digest[:] = np.reshape(partial_state, (8, -1))
+	for i in xrange(first_round, 64):
+		if i >= first_schedule:
+			data[i] = R(data[i-2], data[i-7], data[i-15], data[i-16])
+		(digest[~(i-4)&7], digest[~(i-8)&7]) = sharound(digest[(~(i-1)&7)],digest[~(i-2)&7],digest[~(i-3)&7],digest[~(i-4)&7],digest[~(i-5)&7],digest[~(i-6)&7],digest[~(i-7)&7],digest[~(i-8)&7],data[i],K[i])
+	return digest + initial
+
+def hash_nonces(midstate, merkle_end, time, difficulty, nonces):
+	nonces = np.asarray(nonces, np.uint32)
+	work = np.zeros((64, len(nonces)), np.uint32)
+	work[0]=merkle_end; work[1]=time; work[2]=difficulty; work[3]=nonces
+	work[4]=0x80000000; work[15]=0x00000280
+
+	state = sha256_vector(midstate, work)
+
+	work.fill(0)
+	work[:8]=state
+	work[8]=0x80000000; work[15]=0x00000100
+
+	hashes = sha256_vector(STATE, work)
+	return hashes[7] == 0, hashes.T
+
+def search(midstate, state2, f, merkle_end, time, difficulty, nonces):
+	work = np.zeros((64, len(nonces)), np.uint32)
+	work[0]=merkle_end; work[1]=time; work[2]=difficulty; work[3]=nonces
+	work[4]=0x80000000; work[15]=0x00000280
+	work[16]=f[1]; work[17]=f[2]
+
+	# rounds 0-2 and W16, W17 don't depend on the nonce, see partial and calculateF
+	state = sha256_vector(midstate, work, state2, 3, 18)
+
+	work.fill(0)
+	work[:8]=state
+	work[8]=0x80000000; work[15]=0x00000100
+
+	hashes = sha256_vector(STATE, work)
+	return nonces[hashes[7] == 0]
+
+def hash_headers(header, time, difficulty, nonces):
+	hashes = np.empty((len(nonces), 8), np.uint32)
+	for i in xrange(len(nonces)):
+		data = pack('>20I', *unpack('<20I', header + pack('<III', long(time), long(difficulty), long(nonces[i]))))
+		hashes[i] = unpack('>8I', hashlib.sha256(hashlib.sha256(data).digest()).digest())
+	return hashes[:, 7] == 0, hashes
+
+if __name__ == '__main__':
+	from timeit import timeit
+
+	count = 16
+	header = ''.join(chr(i) for i in xrange(68))
+	midstate = sha256(STATE, np.insert(np.zeros(64, np.uint32), [0] * 16, unpack('16I', header[:64])))
+	merkle_end, time, difficulty = (np.uint32(x) for x in unpack('III', header[64:68] + pack('II', 0x4f2b5e3a, 0x1a0abbcf)))
+	nonces = np.arange(1, count + 1, dtype=np.uint32)
+
+	assert (hash_headers(header, time, difficulty, nonces)[1] == hash_nonces(midstate, merkle_end, time, difficulty, nonces)[1]).all()
+
+	for name, function in (
+		('hash', lambda: [hash(midstate, merkle_end, time, difficulty, nonce) for nonce in nonces]),
+		('hash_nonces', lambda: hash_nonces(midstate, merkle_end, time, difficulty, nonces)),
+		('hash_headers', lambda: hash_headers(header, time, difficulty, nonces))):
+		print '%-12s %10.1f us per %d nonces' % (name, timeit(function, number=10) / 10 * 1e6, count)
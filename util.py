@@ -1,5 +1,6 @@
 from log import say_exception
 from struct import pack, unpack, error
+from threading import Thread
 import sys
 
 class Object(object):
@@ -30,6 +31,20 @@ def chunks(l, n):
 	for i in xrange(0, len(l), n):
 		yield l[i:i+n]
 
+def parallel(function, items):
+	results = [None] * len(items)
+	def run(i):
+		try:
+			results[i] = function(items[i])
+		except Exception:
+			say_exception()
+	threads = [Thread(target=run, args=(i,)) for i in xrange(len(items))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
 def tokenize(option, name, default=[0], cast=int):
 	if option:
 		try: